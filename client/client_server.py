@@ -12,6 +12,9 @@ import threading
 from typing import *
 from concurrent.futures import ThreadPoolExecutor
 import logging
+import logging.handlers
+import queue
+import atexit
 import requests
 import base64
 from pathlib import Path
@@ -85,7 +88,13 @@ except ImportError as e:
     print(f"导入 Cerebras 客户端失败: {e}")
     cerebras_chat = cerebras_stream = None
 
-logging.basicConfig(level=logging.INFO)
+# 日志经队列交给后台线程输出，避免在事件循环中同步写 stdout
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 app = Quart(__name__)
@@ -1621,6 +1630,13 @@ async def internal_error(error):
     return jsonify(create_error_response("internal_error", "服务器内部错误", 500)), 500
 
 if __name__ == '__main__':
+    # 安装了 uvloop 时使用其事件循环策略；设置环境变量 DISABLE_UVLOOP=1 可关闭
+    if os.environ.get("DISABLE_UVLOOP", "") not in ("1", "true", "True"):
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
     app.run(host='0.0.0.0', port=8000, debug=False)
 
 
@@ -1,44 +1,162 @@
 # openrouter_client.py
 import asyncio
 import aiohttp
-import json
+import collections
+import contextlib
+import logging
 import base64
 import mimetypes
 import os
-from typing import AsyncGenerator, Optional, List, Union
+import threading
+from typing import AsyncGenerator, Callable, Optional, List, Union
 from pathlib import Path
 
+from data.openrouter_accounts import API_KEYS
+
+# 优先使用 orjson 解析/序列化 JSON，未安装时回退到标准库
+try:
+    import orjson as _json
+    _dumps = _json.dumps
+except ImportError:
+    import json as _json
+
+    def _dumps(obj) -> bytes:
+        return _json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+logger = logging.getLogger(__name__)
+
 # 配置常量
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 MODEL_NAME = "x-ai/grok-4-fast:free"
 TIMEOUT = 60
-import sys
-import os
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from data.openrouter_accounts import *
+MAX_RETRIES = 5
+
+# 与密钥本身相关的错误状态码（鉴权/额度/限流），遇到时轮换密钥重试；5xx 同样重试
+_KEY_ERROR_STATUSES = frozenset({401, 402, 403, 429})
+
+# SSE 帧前缀与结束标记
+_SSE_DATA = b"data: "
+_SSE_DONE = b"[DONE]"
+
+# 常见图片后缀对应的 data URI 前缀
+_MIME_PREFIX = {
+    ".jpg": "data:image/jpeg;base64,",
+    ".jpeg": "data:image/jpeg;base64,",
+    ".png": "data:image/png;base64,",
+    ".webp": "data:image/webp;base64,",
+    ".gif": "data:image/gif;base64,",
+}
+
+# 可用密钥轮转队列与失败的密钥集合
+_active_keys = collections.deque(API_KEYS)
+_failed_keys: set = set()
+_keys_lock = threading.Lock()
+
+# 已上传图片的URL缓存，键为 (路径, 修改时间, 大小)，进程生命周期内有效
+_uploaded_image_urls: dict = {}
 
-# 失败的密钥集合
-failed_keys = set()
+def _mark_failed(key: str) -> None:
+    """将密钥移出轮转队列并标记为失败"""
+    with _keys_lock:
+        if key in _failed_keys:
+            return
+        try:
+            _active_keys.remove(key)
+        except ValueError:
+            pass
+        _failed_keys.add(key)
+
+async def _iter_sse_data(stream) -> AsyncGenerator[Optional[bytes], None]:
+    """按块读取SSE流并在本地切分行，逐个产出 data 负载（bytes），遇到 [DONE] 结束
+    
+    每处理完一个网络数据块额外产出一次 None，便于调用方在此时刷新缓冲。
+    """
+    buf = bytearray()
+    async for chunk in stream.iter_chunked(16384):
+        buf += chunk
+        start = 0
+        while (nl := buf.find(b"\n", start)) != -1:
+            raw = bytes(buf[start:nl])
+            start = nl + 1
+            # 直接在bytes上解析SSE，仅对有效负载做JSON解码；
+            # 空行、":"心跳注释及 id:/event: 等字段均在前缀检查处跳过
+            if not raw.startswith(_SSE_DATA):
+                continue
+            payload = raw[6:].rstrip(b"\r\n")
+            if not payload:
+                continue
+            if payload == _SSE_DONE:
+                return
+            yield payload
+        del buf[:start]
+        yield None
 
 class OpenRouterClient:
-    def __init__(self, max_concurrent: int = 5):
-        self.semaphore = asyncio.Semaphore(max_concurrent)
+    def __init__(self,
+                 max_concurrent: int = 5,
+                 image_uploader: Optional[Callable[[str], str]] = None):
+        """
+        Args:
+            max_concurrent: 最大并发请求数
+            image_uploader: 可选的图片上传函数，接收本地路径并返回可公开访问的URL；
+                设置后本地图片以URL形式发送，不再进行base64编码
+        """
+        self.image_uploader = image_uploader
+        # 用条件变量保护的计数器替代信号量，便于运行时调整并发上限
+        self._cond = asyncio.Condition()
+        self._in_flight = 0
+        self._limit = max_concurrent
+        self._base_headers = {
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://github.com",  # OpenRouter要求
+            "X-Title": "OpenRouter Client"
+        }
         
+    async def set_limit(self, new_limit: int) -> None:
+        """动态调整最大并发数"""
+        async with self._cond:
+            self._limit = max(1, new_limit)
+            self._cond.notify_all()
+    
+    @contextlib.asynccontextmanager
+    async def _slot(self):
+        """占用一个并发名额"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self._limit)
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._in_flight -= 1
+                self._cond.notify(1)
+    
     def get_available_key(self) -> Optional[str]:
-        """获取可用的API密钥"""
-        global failed_keys
-        available_keys = [key for key in API_KEYS if key not in failed_keys]
-        if not available_keys:
-            # 如果没有可用密钥，重置失败集合并重试
-            if failed_keys:
-                failed_keys.clear()
-                available_keys = API_KEYS.copy()
-            if not available_keys:
-                return None
-        return random.choice(available_keys)
+        """获取可用的API密钥（轮转队列，O(1)）"""
+        with _keys_lock:
+            if not _active_keys:
+                # 如果没有可用密钥，重置失败集合并重试
+                if _failed_keys:
+                    _failed_keys.clear()
+                    _active_keys.extend(API_KEYS)
+                if not _active_keys:
+                    return None
+            key = _active_keys[0]
+            _active_keys.rotate(-1)
+            return key
     
-    def _prepare_image_content(self, image_path_or_url: Union[str, Path]) -> dict:
-        """准备图片内容，支持本地文件和URL"""
+    def _prepare_image_content(self,
+                               image_path_or_url: Union[str, Path],
+                               mode: Optional[str] = None) -> dict:
+        """准备图片内容，支持本地文件和URL
+        
+        Args:
+            image_path_or_url: 本地图片路径或图片URL
+            mode: 本地图片的发送方式，"base64" 内联编码，"url" 通过 image_uploader
+                上传后引用URL；默认在设置了 image_uploader 时使用 "url"
+        """
+        if mode is None:
+            mode = "url" if self.image_uploader else "base64"
         if isinstance(image_path_or_url, Path):
             image_path_or_url = str(image_path_or_url)
         
@@ -52,98 +170,184 @@ class OpenRouterClient:
             }
         else:
             # 本地文件图片
-            if not os.path.exists(image_path_or_url):
-                raise FileNotFoundError(f"图片文件不存在: {image_path_or_url}")
+            # 一次stat同时完成存在性检查并取得缓存键与文件大小
+            try:
+                st = os.stat(image_path_or_url)
+            except FileNotFoundError:
+                raise FileNotFoundError(f"图片文件不存在: {image_path_or_url}") from None
             
-            # 读取图片并编码为base64
-            with open(image_path_or_url, 'rb') as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
+            if mode == "url":
+                return {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": self._upload_image(image_path_or_url, st)
+                    }
+                }
             
-            # 获取MIME类型
-            mime_type, _ = mimetypes.guess_type(image_path_or_url)
-            if not mime_type:
-                mime_type = "image/jpeg"  # 默认类型
+            # 读取图片并编码为base64（已知大小，直接一次读取）
+            fd = os.open(image_path_or_url, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            try:
+                raw = os.read(fd, st.st_size)
+            finally:
+                os.close(fd)
+            image_data = base64.b64encode(raw).decode('utf-8')
+            
+            # 获取data URI前缀，常见后缀直接查表
+            suffix = os.path.splitext(image_path_or_url)[1].lower()
+            prefix = _MIME_PREFIX.get(suffix)
+            if prefix is None:
+                mime_type, _ = mimetypes.guess_type(image_path_or_url)
+                prefix = f"data:{mime_type or 'image/jpeg'};base64,"  # 默认类型
             
             return {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:{mime_type};base64,{image_data}"
+                    "url": prefix + image_data
                 }
             }
     
-    async def chat_stream(self, 
-                         prompt: str, 
-                         image_paths: Optional[List[Union[str, Path]]] = None,
-                         temperature: float = 0.2) -> AsyncGenerator[str, None]:
-        """流式聊天，支持多模态"""
-        global failed_keys
-        api_key = self.get_available_key()
-        if not api_key:
-            raise RuntimeError("没有可用的API密钥")
-            
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://github.com",  # OpenRouter要求
-            "X-Title": "OpenRouter Client"
-        }
+    def _upload_image(self, image_path: str, st: os.stat_result) -> str:
+        """上传本地图片并返回URL，相同文件在进程内只上传一次"""
+        if self.image_uploader is None:
+            raise RuntimeError("未设置 image_uploader，无法以URL方式发送本地图片")
+        
+        cache_key = (os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+        url = _uploaded_image_urls.get(cache_key)
+        if url is None:
+            url = self.image_uploader(image_path)
+            _uploaded_image_urls[cache_key] = url
+        return url
+    
+    async def _build_messages(self,
+                              prompt: str,
+                              image_paths: Optional[List[Union[str, Path]]]) -> list:
+        """构建消息列表，纯文本时直接使用字符串作为content"""
+        if not image_paths:
+            return [{"role": "user", "content": prompt}]
         
         # 构建消息内容
         content = [{"type": "text", "text": prompt}]
         
-        # 添加图片内容
-        if image_paths:
-            for image_path in image_paths:
-                image_content = self._prepare_image_content(image_path)
-                content.append(image_content)
-        
+        # 添加图片内容（在线程中并行编码，避免阻塞事件循环）
+        encoded = await asyncio.gather(
+            *[asyncio.to_thread(self._prepare_image_content, p) for p in image_paths]
+        )
+        content.extend(encoded)
+        return [{"role": "user", "content": content}]
+    
+    async def _build_body(self,
+                          prompt: str,
+                          image_paths: Optional[List[Union[str, Path]]],
+                          temperature: float,
+                          stream: bool) -> bytes:
+        """构建并序列化请求体"""
         body = {
             "model": MODEL_NAME,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": content
-                }
-            ],
-            "stream": True,
+            "messages": await self._build_messages(prompt, image_paths),
+            "stream": stream,
             "max_tokens": 4000,
             "temperature": temperature
         }
+        return _dumps(body)
+    
+    @contextlib.asynccontextmanager
+    async def _post(self, session: aiohttp.ClientSession, body: bytes, api_key: str):
+        """发送请求，失败时指数退避并轮换密钥重试，返回状态码为200的响应"""
+        headers = {**self._base_headers, "Authorization": f"Bearer {api_key}"}
+        attempts = max(1, min(len(API_KEYS), MAX_RETRIES))
         
-        async with self.semaphore:
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(0.1 * 2 ** (attempt - 1))
+                api_key = self.get_available_key()
+                if not api_key:
+                    raise RuntimeError("没有可用的API密钥")
+                headers["Authorization"] = f"Bearer {api_key}"
+            
+            try:
+                response = await session.post(OPENROUTER_URL, headers=headers, data=body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("请求异常 (第%d次): %s", attempt + 1, e)
+                _mark_failed(api_key)
+                if attempt == attempts - 1:
+                    raise
+                continue
+            
+            if response.status != 200:
+                error_text = await response.text()
+                response.release()
+                logger.warning("API错误 (%s): %s", response.status, error_text)
+                # 其他 4xx 是请求本身的问题，换密钥也不会成功，直接报错且不标记密钥
+                if response.status not in _KEY_ERROR_STATUSES and response.status < 500:
+                    raise RuntimeError(f"API调用失败: {error_text}")
+                _mark_failed(api_key)
+                if attempt == attempts - 1:
+                    raise RuntimeError(f"API调用失败: {error_text}")
+                continue
+            
+            try:
+                yield response
+            except Exception:
+                _mark_failed(api_key)
+                raise
+            finally:
+                response.release()
+            return
+    
+    async def chat_stream(self, 
+                         prompt: str, 
+                         image_paths: Optional[List[Union[str, Path]]] = None,
+                         temperature: float = 0.2,
+                         flush_every: int = 1) -> AsyncGenerator[str, None]:
+        """流式聊天，支持多模态
+        
+        Args:
+            flush_every: 累积到该字符数或当前网络数据块解析完毕时才产出一次，
+                默认为1即逐条产出
+        """
+        api_key = self.get_available_key()
+        if not api_key:
+            raise RuntimeError("没有可用的API密钥")
+            
+        body = await self._build_body(prompt, image_paths, temperature, stream=True)
+        
+        async with self._slot():
             timeout = aiohttp.ClientTimeout(total=TIMEOUT)
             
             try:
                 async with aiohttp.ClientSession(timeout=timeout) as session:
-                    async with session.post(OPENROUTER_URL, headers=headers, json=body) as response:
-                        if response.status != 200:
-                            error_text = await response.text()
-                            print(f"API错误 ({response.status}): {error_text}")
-                            failed_keys.add(api_key)
-                            raise RuntimeError(f"API调用失败: {error_text}")
-                        
-                        async for line in response.content:
-                            line = line.decode("utf-8").strip()
-                            if not line.startswith("data: "):
+                    async with self._post(session, body, api_key) as response:
+                        pending = []
+                        pending_len = 0
+                        async for payload in _iter_sse_data(response.content):
+                            if payload is None:
+                                if pending:
+                                    yield "".join(pending)
+                                    pending.clear()
+                                    pending_len = 0
                                 continue
                             
-                            data = line[6:]
-                            if data == "[DONE]":
-                                break
-                            
                             try:
-                                chunk = json.loads(data)
-                                if chunk.get("choices"):
-                                    delta = chunk["choices"][0].get("delta", {})
-                                    content = delta.get("content", "")
-                                    if content:
-                                        yield content
-                            except json.JSONDecodeError:
+                                chunk = _json.loads(payload)
+                            except ValueError:
+                                continue
+                            if not chunk.get("choices"):
                                 continue
+                            delta = chunk["choices"][0].get("delta", {})
+                            content = delta.get("content", "")
+                            if content:
+                                pending.append(content)
+                                pending_len += len(content)
+                                if pending_len >= flush_every:
+                                    yield "".join(pending)
+                                    pending.clear()
+                                    pending_len = 0
+                        
+                        if pending:
+                            yield "".join(pending)
                                 
             except Exception as e:
-                print(f"流式调用异常: {e}")
-                failed_keys.add(api_key)
+                logger.warning("流式调用异常: %s", e)
                 raise
     
     async def chat(self, 
@@ -151,58 +355,23 @@ class OpenRouterClient:
                   image_paths: Optional[List[Union[str, Path]]] = None,
                   temperature: float = 0.2) -> str:
         """非流式聊天，支持多模态"""
-        global failed_keys
         api_key = self.get_available_key()
         if not api_key:
             raise RuntimeError("没有可用的API密钥")
             
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://github.com",  # OpenRouter要求
-            "X-Title": "OpenRouter Client"
-        }
-        
-        # 构建消息内容
-        content = [{"type": "text", "text": prompt}]
+        body = await self._build_body(prompt, image_paths, temperature, stream=False)
         
-        # 添加图片内容
-        if image_paths:
-            for image_path in image_paths:
-                image_content = self._prepare_image_content(image_path)
-                content.append(image_content)
-        
-        body = {
-            "model": MODEL_NAME,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": content
-                }
-            ],
-            "stream": False,
-            "max_tokens": 4000,
-            "temperature": temperature
-        }
-        
-        async with self.semaphore:
+        async with self._slot():
             timeout = aiohttp.ClientTimeout(total=TIMEOUT)
             
             try:
                 async with aiohttp.ClientSession(timeout=timeout) as session:
-                    async with session.post(OPENROUTER_URL, headers=headers, json=body) as response:
-                        if response.status != 200:
-                            error_text = await response.text()
-                            print(f"API错误 ({response.status}): {error_text}")
-                            failed_keys.add(api_key)
-                            raise RuntimeError(f"API调用失败: {error_text}")
-                        
-                        data = await response.json()
+                    async with self._post(session, body, api_key) as response:
+                        data = await response.json(loads=_json.loads)
                         return data['choices'][0]['message']['content'].strip()
                         
             except Exception as e:
-                print(f"非流式调用异常: {e}")
-                failed_keys.add(api_key)
+                logger.warning("非流式调用异常: %s", e)
                 raise
 
 # 便捷函数
@@ -252,5 +421,4 @@ async def main():
         print(f"错误: {e}")
 
 if __name__ == "__main__":
-    import random
     asyncio.run(main())
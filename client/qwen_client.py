@@ -9,18 +9,22 @@ import os
 import mimetypes
 import base64
 import hmac
-import threading
+import functools
+import contextlib
 import random
 import pickle
+import struct
 import numpy as np
-from datetime import datetime, timezone, timedelta
+from email.utils import formatdate
 from urllib.parse import quote, urlencode, parse_qs, urlparse
+from yarl import URL
 from typing import List, Dict, AsyncGenerator, Optional, Union, Tuple
 from dataclasses import dataclass, field
 from asyncio import Lock, Semaphore
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
 import math
+from types import MappingProxyType
 import sys
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
@@ -28,6 +32,152 @@ sys.path.append(parent_dir)
 from ui.consoleui import *
 from data.qwen_accounts import *
 
+# 优先使用 orjson 解析/序列化 JSON，未安装时回退到标准库
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+    
+    def _json_serialize(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    orjson = None
+    _loads = json.loads
+    _json_serialize = json.dumps
+    
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+# 可选的 HTTP/2 流式后端（需要 httpx[http2]），未安装时只使用 aiohttp
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+_STATIC_LOGIN_HEADERS = {
+    "Host": "chat.qwen.ai",
+    "Content-Type": "application/json; charset=UTF-8",
+    "User-Agent": "Mozilla/5.0 (Linux; Android 10; BAH3-W09) AppleWebKit/537.36",
+    "Accept": "*/*",
+    "Origin": "https://chat.qwen.ai",
+    "Referer": "https://chat.qwen.ai/auth?action=signin",
+}
+_LOGIN_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# 各接口固定不变的请求头，调用时只补充 authorization / x-request-id
+_AUTH_FMT = "Bearer %s"
+_BASE_HEADERS = MappingProxyType({
+    "content-type": "application/json; charset=UTF-8",
+    "source": "web",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    "origin": "https://chat.qwen.ai",
+    "referer": "https://chat.qwen.ai/",
+    "accept-language": "zh-CN,zh;q=0.9",
+})
+_NEW_CHAT_HEADERS = MappingProxyType({**_BASE_HEADERS, "accept": "application/json"})
+_STS_HEADERS = MappingProxyType({**_BASE_HEADERS, "accept": "*/*"})
+_COMPLETION_HEADERS = MappingProxyType({
+    **_BASE_HEADERS,
+    "content-type": "application/json; charset=utf-8",
+    "x-accel-buffering": "no",
+    "accept": "text/event-stream",
+    "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
+    "accept-charset": "utf-8",
+})
+
+# 聊天载荷模板：导入时序列化一次，字符串占位符 "__NAME__" 在请求时替换为对应的 JSON 片段
+_TEMPLATE_SLOT_RE = re.compile(rb'"__([A-Z_]+?)__"')
+
+def _compile_template(skeleton: Dict) -> Tuple[Tuple[bytes, ...], Tuple[str, ...]]:
+    raw = _dumps(skeleton)
+    parts, names = [], []
+    pos = 0
+    for m in _TEMPLATE_SLOT_RE.finditer(raw):
+        parts.append(raw[pos:m.start()])
+        names.append(m.group(1).decode())
+        pos = m.end()
+    parts.append(raw[pos:])
+    return tuple(parts), tuple(names)
+
+def _render_template(template: Tuple[Tuple[bytes, ...], Tuple[str, ...]], values: Dict[str, bytes]) -> bytes:
+    parts, names = template
+    out = [parts[0]]
+    for name, part in zip(names, parts[1:]):
+        out.append(values[name])
+        out.append(part)
+    return b"".join(out)
+
+_PAYLOAD_TEMPLATE = _compile_template({
+    "stream": True,
+    "incremental_output": True,
+    "chat_id": "__CHAT_ID__",
+    "chat_mode": "normal",
+    "model": "__MODEL__",
+    "parent_id": None,
+    "messages": [{
+        "fid": "__FID__",
+        "parentId": None,
+        "childrenIds": ["__CHILD_ID__"],
+        "role": "user",
+        "content": "__CONTENT__",
+        "user_action": "chat",
+        "files": "__FILES__",
+        "timestamp": "__TIMESTAMP__",
+        "models": ["__MODEL__"],
+        "chat_type": "t2t",
+        "feature_config": {
+            "thinking_enabled": False,
+            "output_schema": "phase",
+            "thinking_budget": 1024,
+            "mcp": {}
+        },
+        "generate_cfg": {
+            "max_input_tokens": 1048576,
+            "max_tokens": 1048576,
+            "max_new_tokens": "__MAX_NEW_TOKENS__",
+            "seed": -1,
+            "function_choice": "none",
+            "system_message": " ",
+            "fncall_prompt_type": "qwen",
+            "incremental_output": True,
+            "skip_stopword_postproc": False,
+            "max_retries": 3,
+            "cache_dir": "./cache"
+        },
+        "extra": {"meta": {"subChatType": "t2t"}},
+        "sub_chat_type": "t2t",
+        "parent_id": None,
+    }],
+    "timestamp": "__TIMESTAMP__",
+})
+
+class _UuidPool:
+    """批量读取随机字节生成 UUID4，每 256 个 UUID 只调用一次 os.urandom"""
+    
+    def __init__(self, batch: int = 256):
+        self._batch = batch
+        self._buf = b''
+        self._off = 0
+    
+    def _next_uuid(self) -> uuid.UUID:
+        if self._off >= len(self._buf):
+            self._buf = os.urandom(16 * self._batch)
+            self._off = 0
+        b = self._buf[self._off:self._off + 16]
+        self._off += 16
+        return uuid.UUID(bytes=b, version=4)
+    
+    def next(self) -> str:
+        return str(self._next_uuid())
+    
+    def next_hex(self) -> str:
+        return self._next_uuid().hex
+
+_uuid_pool = _UuidPool()
+
+# token 估算：第 1 组匹配连续的中文字符，第 2 组匹配英文单词
+_TOKEN_RE = re.compile(r'([\u4e00-\u9fff]+)|([a-zA-Z]+)')
+
 
 FILE_TYPE_MAPPING = {
     'image/jpeg': 'image', 'image/jpg': 'image', 'image/png': 'image', 'image/gif': 'image',
@@ -72,6 +222,116 @@ EXTENSION_TO_MIME = {
     '.sh': 'text/x-shell', '.bash': 'text/x-shell', '.zsh': 'text/x-shell',
 }
 
+# 只读的小写后缀 -> MIME 映射，查表时无需再规范化键
+_EXT_TO_MIME = MappingProxyType({ext.lower(): mime for ext, mime in EXTENSION_TO_MIME.items()})
+
+def _klucb_bisect_py(p: float, level: float, precision: float = 1e-6) -> float:
+    """二分求解 KL-UCB 上界：满足 kl(p, q) <= level 的最大 q"""
+    if p >= 1.0 - precision:
+        return 1.0
+    
+    if level <= precision:
+        return p
+    
+    # p == 0 时 kl(0, q) = -log(1 - q)，有闭式解
+    if p <= precision:
+        return 1.0 - math.exp(-level)
+    
+    # 置信半径很大时上界已贴近 1，无需二分
+    if level > 5.0:
+        return 1.0 - precision
+    
+    low, high = p, 1.0
+    
+    # 区间长度每次减半，30 次迭代已远低于 precision
+    for _ in range(30):
+        mid = (low + high) / 2.0
+        
+        if mid <= precision or mid >= 1.0 - precision:
+            break
+        
+        if p > precision:
+            kl_div = p * math.log(p / mid)
+        else:
+            kl_div = 0.0
+            
+        if p < 1.0 - precision:
+            kl_div += (1 - p) * math.log((1 - p) / (1 - mid))
+        
+        if kl_div <= level:
+            low = mid
+        else:
+            high = mid
+        
+        if high - low < precision:
+            break
+    
+    return (low + high) / 2.0
+
+def _klucb_bisect_vec_py(p_arr: np.ndarray, level_arr: np.ndarray, out: np.ndarray,
+                         precision: float = 1e-6) -> None:
+    """_klucb_bisect 的 NumPy 向量化版本，结果写入 out"""
+    low = p_arr.copy()
+    high = np.ones_like(p_arr)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(30):
+            mid = (low + high) / 2.0
+            kl_div = np.where(p_arr > precision, p_arr * np.log(p_arr / mid), 0.0)
+            kl_div += (1 - p_arr) * np.log((1 - p_arr) / (1 - mid))
+            within = kl_div <= level_arr
+            low = np.where(within, mid, low)
+            high = np.where(within, high, mid)
+    
+    bound = (low + high) / 2.0
+    bound = np.where(level_arr > 5.0, 1.0 - precision, bound)
+    bound = np.where(p_arr <= precision, -np.expm1(-level_arr), bound)
+    bound = np.where(level_arr <= precision, p_arr, bound)
+    out[:] = np.where(p_arr >= 1.0 - precision, 1.0, bound)
+
+# 安装了 numba 时将二分循环编译为本地代码，否则使用纯 Python / NumPy 实现
+try:
+    from numba import njit, prange
+    
+    _klucb_bisect = njit(cache=True, fastmath=True)(_klucb_bisect_py)
+    
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _klucb_bisect_vec(p_arr, level_arr, out, precision=1e-6):
+        for i in prange(p_arr.shape[0]):
+            out[i] = _klucb_bisect(p_arr[i], level_arr[i], precision)
+    
+    # 导入时预热，避免首个请求承担编译开销
+    _klucb_bisect(0.5, 0.1, 1e-6)
+    _klucb_bisect_vec(np.array([0.5]), np.array([0.1]), np.empty(1), 1e-6)
+except ImportError:
+    _klucb_bisect = _klucb_bisect_py
+    _klucb_bisect_vec = _klucb_bisect_vec_py
+
+# 统计日志记录：success, message_length, first_packet_delay, generation_tokens,
+# generation_time, timestamp, email 字节长度；其后紧跟 email 的 UTF-8 字节
+_JOURNAL_RECORD = struct.Struct('<?IdIddH')
+# 日志文件头：魔数 + 代号。快照记录自己的代号，每写一次快照代号加一并重置日志，
+# 加载时只重放与快照代号相同的日志，快照替换后、日志清空前崩溃也不会重复计数
+_JOURNAL_MAGIC = b'KLJ1'
+_JOURNAL_HEADER = struct.Struct('<4sQ')
+
+# 每累计多少次更新写一次完整快照并清空日志
+STATS_SNAPSHOT_EVERY = 5000
+# 后台刷盘间隔（秒），期间的更新合并为一次写入
+STATS_FLUSH_INTERVAL = 2.0
+
+# 账号统计快照的行格式（np.savez_compressed 存储，字段与 AccountStats 一一对应）
+_STATS_DTYPE = np.dtype([
+    ('success_count', '<u4'),
+    ('total_attempts', '<u4'),
+    ('total_message_length', '<u8'),
+    ('total_first_packet_delay', '<f8'),
+    ('total_generation_tokens', '<u8'),
+    ('total_generation_time', '<f8'),
+    ('last_updated', '<f8'),
+])
+_STATS_FIELDS = _STATS_DTYPE.names
+
 @dataclass
 class AccountStats:
     email: str
@@ -82,22 +342,21 @@ class AccountStats:
     total_generation_tokens: int = 0
     total_generation_time: float = 0.0
     last_updated: float = field(default_factory=time.time)
+    # 派生指标，在更新时计算一次，读取时不再做除法
+    success_rate: float = field(default=0.0, init=False)
+    avg_message_length: float = field(default=0.0, init=False)
+    avg_first_packet_delay: float = field(default=0.0, init=False)
+    generation_speed: float = field(default=0.0, init=False)
     
-    @property
-    def success_rate(self) -> float:
-        return self.success_count / max(self.total_attempts, 1)
-    
-    @property
-    def avg_message_length(self) -> float:
-        return self.total_message_length / max(self.success_count, 1)
-    
-    @property
-    def avg_first_packet_delay(self) -> float:
-        return self.total_first_packet_delay / max(self.success_count, 1)
+    def __post_init__(self):
+        self._refresh_derived()
     
-    @property
-    def generation_speed(self) -> float:
-        return self.total_generation_tokens / max(self.total_generation_time, 0.001)
+    def _refresh_derived(self):
+        successes = max(self.success_count, 1)
+        self.success_rate = self.success_count / max(self.total_attempts, 1)
+        self.avg_message_length = self.total_message_length / successes
+        self.avg_first_packet_delay = self.total_first_packet_delay / successes
+        self.generation_speed = self.total_generation_tokens / max(self.total_generation_time, 0.001)
     
     def update_success(self, message_length: int, first_packet_delay: float, generation_tokens: int, generation_time: float):
         self.success_count += 1
@@ -107,89 +366,315 @@ class AccountStats:
         self.total_generation_tokens += generation_tokens
         self.total_generation_time += generation_time
         self.last_updated = time.time()
+        self._refresh_derived()
     
     def update_failure(self):
         self.total_attempts += 1
+        self.success_rate = self.success_count / self.total_attempts
         self.last_updated = time.time()
 
 class AdvancedKLUCBOptimizer:
     
     def __init__(self, stats_file: str = r"E:\我的\python\new\Nbot0.4.0\data\account_stats.pkl", debug: bool = False):
         self.stats_file = stats_file
+        self.journal_file = stats_file + '.journal'
         self.debug = debug
+        # 统计文件的读写全部交给单线程执行器，保证顺序且不阻塞事件循环
+        self._io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='klucb-stats')
+        self._updates_since_snapshot = 0
+        # 待写入的日志记录，由 flush_worker 定期合并写出
+        self._pending_records: List[bytes] = []
+        self._snapshot_due = False
+        self._dirty = False
         self.account_stats: Dict[str, AccountStats] = {}
         self.global_attempts = 0
         self.failed_accounts = set()
+        # 结构化数组：每个账号一行，供批量评分和快照共用
+        self._row: Dict[str, int] = {}
+        self._stats_arr = np.zeros(0, dtype=_STATS_DTYPE)
+        # 得分缓存：(email, 消息长度) -> (计算时的 global_attempts, 得分)
+        self._score_cache: Dict[Tuple[str, int], Tuple[int, float]] = {}
+        self._score_cache_keys: Dict[str, set] = {}
+        # 当前快照代号；日志代号不一致时下次追加前先重置日志（只在 IO 线程中修改）
+        self._journal_gen = 0
+        self._journal_needs_reset = False
         self.load_stats()
     
-    def _debug_print(self, message: str):
-        if self.debug:
-            pass
-    
     def load_stats(self):
+        self._journal_gen = 0
         try:
             if os.path.exists(self.stats_file):
                 with open(self.stats_file, 'rb') as f:
-                    data = pickle.load(f)
-                    self.account_stats = data.get('account_stats', {})
-                    self.global_attempts = data.get('global_attempts', 0)
-                    self.failed_accounts = data.get('failed_accounts', set())
+                    if f.read(2) == b'PK':
+                        f.seek(0)
+                        self._load_npz(f)
+                    else:
+                        # 兼容旧版 pickle 格式，下次快照时自动转换
+                        f.seek(0)
+                        data = pickle.load(f)
+                        self.account_stats = data.get('account_stats', {})
+                        self.global_attempts = data.get('global_attempts', 0)
+                        self.failed_accounts = data.get('failed_accounts', set())
+                        # 旧快照中的对象没有派生字段，需要补算
+                        for stats in self.account_stats.values():
+                            stats._refresh_derived()
+            self._replay_journal()
         except Exception as e:
             self.account_stats = {}
             self.global_attempts = 0
             self.failed_accounts = set()
+            self._journal_needs_reset = True
+        self._rebuild_arrays()
+    
+    def _load_npz(self, f):
+        with np.load(f, allow_pickle=False) as data:
+            stats = data['stats']
+            self.account_stats = {
+                email: AccountStats(email, *(row[name].item() for name in _STATS_FIELDS))
+                for email, row in zip(data['emails'].tolist(), stats)
+            }
+            globals_ = data['globals']
+            self.global_attempts = int(globals_[0])
+            # 旧快照没有代号，视为 0
+            self._journal_gen = int(globals_[1]) if len(globals_) > 1 else 0
+            self.failed_accounts = set(data['failed'].tolist())
+    
+    def _rebuild_arrays(self):
+        """根据 account_stats 重建结构化数组"""
+        capacity = max(len(self.account_stats), 64)
+        self._row = {}
+        self._stats_arr = np.zeros(capacity, dtype=_STATS_DTYPE)
+        for email in self.account_stats:
+            self._sync_row(email)
+    
+    def _sync_row(self, email: str):
+        """将单个账号的统计同步到结构化数组"""
+        row = self._row.get(email)
+        if row is None:
+            row = len(self._row)
+            if row >= len(self._stats_arr):
+                grown = np.zeros(max(len(self._stats_arr) * 2, 64), dtype=_STATS_DTYPE)
+                grown[:row] = self._stats_arr[:row]
+                self._stats_arr = grown
+            self._row[email] = row
+        
+        stats = self.account_stats[email]
+        self._stats_arr[row] = tuple(getattr(stats, name) for name in _STATS_FIELDS)
     
-    def save_stats(self):
+    def _replay_journal(self):
+        """在快照之上重放增量日志，快照已包含的旧代号日志直接跳过"""
+        if not os.path.exists(self.journal_file):
+            return
+        
+        with open(self.journal_file, 'rb') as f:
+            data = f.read()
+        
+        if data[:len(_JOURNAL_MAGIC)] == _JOURNAL_MAGIC:
+            if len(data) < _JOURNAL_HEADER.size:
+                return
+            _, gen = _JOURNAL_HEADER.unpack_from(data, 0)
+            offset = _JOURNAL_HEADER.size
+        else:
+            # 没有文件头的旧日志，只能与没有代号的旧快照搭配
+            gen = 0
+            offset = 0
+        if gen != self._journal_gen:
+            self._journal_needs_reset = True
+            return
+        
+        while offset + _JOURNAL_RECORD.size <= len(data):
+            (success, message_length, first_packet_delay, generation_tokens,
+             generation_time, timestamp, email_len) = _JOURNAL_RECORD.unpack_from(data, offset)
+            offset += _JOURNAL_RECORD.size
+            if offset + email_len > len(data):
+                break  # 末尾记录写入不完整
+            email = data[offset:offset + email_len].decode('utf-8')
+            offset += email_len
+            
+            stats = self._apply_result(email, success, message_length, first_packet_delay,
+                                       generation_tokens, generation_time)
+            stats.last_updated = timestamp
+    
+    def _snapshot_payload(self) -> Dict[str, np.ndarray]:
+        return {
+            'stats': self._stats_arr[:len(self._row)].copy(),
+            'emails': np.array(list(self._row), dtype=str),
+            'globals': np.array([self.global_attempts], dtype='<u8'),
+            'failed': np.array(list(self.failed_accounts), dtype=str),
+        }
+    
+    def _write_snapshot(self, payload: Dict[str, np.ndarray]):
+        """写入带新代号的完整快照，再以新代号重置日志（在 IO 线程中执行）"""
+        gen = self._journal_gen + 1
+        payload = {**payload, 'globals': np.array([payload['globals'][0], gen], dtype='<u8')}
         try:
             os.makedirs(os.path.dirname(self.stats_file), exist_ok=True)
-            data = {
-                'account_stats': self.account_stats,
-                'global_attempts': self.global_attempts,
-                'failed_accounts': self.failed_accounts
-            }
-            with open(self.stats_file, 'wb') as f:
-                pickle.dump(data, f)
+            tmp_file = self.stats_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.savez_compressed(f, **payload)
+            os.replace(tmp_file, self.stats_file)
+        except Exception as e:
+            return
+        
+        # 快照已替换：此后旧日志的代号与快照不一致，加载时会被忽略
+        self._journal_gen = gen
+        self._journal_needs_reset = True
+        self._reset_journal()
+    
+    def _reset_journal(self):
+        """清空日志并写入当前代号的文件头（在 IO 线程中执行）"""
+        try:
+            journal_dir = os.path.dirname(self.journal_file)
+            if journal_dir:
+                os.makedirs(journal_dir, exist_ok=True)
+            with open(self.journal_file, 'wb') as f:
+                f.write(_JOURNAL_HEADER.pack(_JOURNAL_MAGIC, self._journal_gen))
+            self._journal_needs_reset = False
+        except Exception as e:
+            pass
+    
+    def _append_journal(self, record: bytes):
+        """追加增量记录（在 IO 线程中执行），新建或代号过期的日志先写文件头"""
+        if self._journal_needs_reset:
+            self._reset_journal()
+            if self._journal_needs_reset:
+                return
+        try:
+            self._write_journal(record)
+        except FileNotFoundError:
+            try:
+                os.makedirs(os.path.dirname(self.journal_file), exist_ok=True)
+                self._write_journal(record)
+            except Exception as e:
+                pass
         except Exception as e:
             pass
     
+    def _write_journal(self, record: bytes):
+        with open(self.journal_file, 'ab') as f:
+            if f.tell() == 0:
+                f.write(_JOURNAL_HEADER.pack(_JOURNAL_MAGIC, self._journal_gen))
+            f.write(record)
+    
+    def _take_pending(self):
+        """取出待写入的内容，返回 (写入函数, 参数)；在事件循环线程中调用"""
+        self._dirty = False
+        if self._snapshot_due:
+            # 快照已包含所有内存中的更新，待写日志直接丢弃
+            self._snapshot_due = False
+            self._pending_records.clear()
+            return self._write_snapshot, self._snapshot_payload()
+        
+        records = b''.join(self._pending_records)
+        self._pending_records.clear()
+        return self._append_journal, records
+    
+    async def flush_worker(self, interval: float = STATS_FLUSH_INTERVAL):
+        """定期将积累的更新写盘，写入在 IO 线程中进行"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            if self._dirty:
+                await loop.run_in_executor(self._io_executor, *self._take_pending())
+    
+    def _take_snapshot(self):
+        """清空待写内容并返回完整快照数据；在事件循环线程中调用"""
+        self._updates_since_snapshot = 0
+        self._snapshot_due = False
+        self._pending_records.clear()
+        self._dirty = False
+        return self._snapshot_payload()
+    
+    async def close(self):
+        """在 IO 线程中写入最终快照（不阻塞事件循环），然后关闭 IO 线程"""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._io_executor, self._write_snapshot, self._take_snapshot())
+        finally:
+            self._io_executor.shutdown(wait=False)
+    
     def _kl_divergence_upper_bound(self, p: float, level: float, precision: float = 1e-6) -> float:
-        if p >= 1.0 - precision:
-            return 1.0
-        
-        if level <= precision:
-            return p
-        
-        low, high = p, 1.0
+        return _klucb_bisect(p, level, precision)
+    
+    def _kl_divergence_upper_bound_batch(self, p: np.ndarray, level: np.ndarray,
+                                         precision: float = 1e-6) -> np.ndarray:
+        """_kl_divergence_upper_bound 的向量化版本，对整组账号同时求上界"""
+        out = np.empty_like(p)
+        _klucb_bisect_vec(p, level, out, precision)
+        return out
+    
+    def _batch_scores(self, rows: np.ndarray, failed: np.ndarray, message_length: int = 0,
+                      log_N: Optional[float] = None) -> np.ndarray:
+        """批量计算 calculate_ultimate_score，rows 为 -1 表示无统计记录"""
+        if log_N is None:
+            log_N = math.log(max(self.global_attempts, 1))
+        known = rows >= 0
+        idx = np.where(known, rows, 0)
+        arr = self._stats_arr[idx]
+        succ = np.where(known, arr['success_count'], 0).astype(np.float64)
+        att = np.where(known, arr['total_attempts'], 0).astype(np.float64)
+        delay_sum = arr['total_first_packet_delay']
+        tok = arr['total_generation_tokens'].astype(np.float64)
+        gen_time = arr['total_generation_time']
+        msg_len_sum = arr['total_message_length'].astype(np.float64)
+        
+        att_safe = np.maximum(att, 1.0)
+        succ_safe = np.maximum(succ, 1.0)
+        has_success = succ > 0
+        
+        confidence_level = log_N / att_safe
+        empirical_success_rate = succ / att_safe
+        ucb_bound = self._kl_divergence_upper_bound_batch(empirical_success_rate, confidence_level)
+        
+        delay_score = np.where(has_success, 1.0 / (1.0 + delay_sum / succ_safe), 0.5)
+        
+        generation_speed = tok / np.maximum(gen_time, 0.001)
+        speed_score = np.where(has_success & (gen_time > 0), np.minimum(generation_speed / 50.0, 2.0), 0.5)
+        
+        if message_length > 0:
+            length_adaptability = np.where(
+                has_success, np.minimum(msg_len_sum / succ_safe / max(message_length, 1), 2.0), 1.0
+            )
+        else:
+            length_adaptability = 1.0
         
-        for _ in range(100):
-            mid = (low + high) / 2.0
-            
-            if mid <= precision or mid >= 1.0 - precision:
-                break
-            
-            if p > precision:
-                kl_div = p * math.log(p / mid)
-            else:
-                kl_div = 0
-                
-            if p < 1.0 - precision:
-                kl_div += (1 - p) * math.log((1 - p) / (1 - mid))
-            
-            if kl_div <= level:
-                low = mid
-            else:
-                high = mid
-            
-            if high - low < precision:
-                break
+        penalty = np.where(failed, 0.1, 1.0)
+        scores = (
+            ucb_bound * 0.4 +
+            delay_score * 0.25 +
+            speed_score * 0.25 +
+            length_adaptability * 0.1
+        ) * penalty
         
-        return (low + high) / 2.0
+        return np.where(att > 0, scores, np.inf)
+    
+    def _invalidate_score_cache(self, email: str):
+        """清除某个账号的得分缓存"""
+        for key in self._score_cache_keys.pop(email, ()):
+            self._score_cache.pop(key, None)
     
-    def calculate_ultimate_score(self, email: str, message_length: int = 0) -> float:
-        """计算终极KL-UCB得分，基于四个核心维度"""
+    def calculate_ultimate_score(self, email: str, message_length: int = 0,
+                                 log_N: Optional[float] = None) -> float:
+        """计算终极KL-UCB得分，基于四个核心维度（按 email 和消息长度缓存）
+        
+        log_N 为预先算好的 log(max(global_attempts, 1))，批量调用时传入可避免重复计算
+        """
         if email not in self.account_stats:
             return float('inf')
         
+        key = (email, message_length)
+        cached = self._score_cache.get(key)
+        if cached is not None and cached[0] == self.global_attempts:
+            return cached[1]
+        
+        score = self._compute_ultimate_score(email, message_length, log_N)
+        self._score_cache[key] = (self.global_attempts, score)
+        self._score_cache_keys.setdefault(email, set()).add(key)
+        return score
+    
+    def _compute_ultimate_score(self, email: str, message_length: int = 0,
+                                log_N: Optional[float] = None) -> float:
+        
         stats = self.account_stats[email]
         
         if stats.total_attempts == 0:
@@ -200,7 +685,9 @@ class AdvancedKLUCBOptimizer:
         else:
             penalty = 1.0
         
-        confidence_level = math.log(max(self.global_attempts, 1)) / stats.total_attempts
+        if log_N is None:
+            log_N = math.log(max(self.global_attempts, 1))
+        confidence_level = log_N / stats.total_attempts
         empirical_success_rate = stats.success_rate
         ucb_bound = self._kl_divergence_upper_bound(empirical_success_rate, confidence_level)
         
@@ -236,15 +723,24 @@ class AdvancedKLUCBOptimizer:
         if not available_accounts:
             return None
         
-        account_scores = []
+        # KL-UCB 冷启动：每个账号先尝试一次，未尝试过的账号得分为 inf，直接返回
         for account in available_accounts:
-            score = self.calculate_ultimate_score(account.email, message_length)
-            account_scores.append((account, score))
+            stats = self.account_stats.get(account.email)
+            if stats is None or stats.total_attempts == 0:
+                return account
         
-        account_scores.sort(key=lambda x: x[1], reverse=True)
-        optimal_account = account_scores[0][0]
+        rows = np.fromiter(
+            (self._row.get(account.email, -1) for account in available_accounts),
+            dtype=np.intp, count=len(available_accounts)
+        )
+        failed = np.fromiter(
+            (account.email in self.failed_accounts for account in available_accounts),
+            dtype=bool, count=len(available_accounts)
+        )
+        log_N = math.log(max(self.global_attempts, 1))
+        scores = self._batch_scores(rows, failed, message_length, log_N)
         
-        return optimal_account
+        return available_accounts[int(np.argmax(scores))]
     
     def update_account_result(self, email: str, success: bool, 
                             message_length: int = 0, 
@@ -252,6 +748,31 @@ class AdvancedKLUCBOptimizer:
                             generation_tokens: int = 0,
                             generation_time: float = 0.0):
         """更新账号结果，记录四个核心维度"""
+        stats = self._apply_result(email, success, message_length, first_packet_delay,
+                                   generation_tokens, generation_time)
+        self._sync_row(email)
+        self._invalidate_score_cache(email)
+        
+        # 只记录待写内容，由 flush_worker 合并写盘：平时追加定长日志，定期写完整快照
+        self._dirty = True
+        self._updates_since_snapshot += 1
+        if self._updates_since_snapshot >= STATS_SNAPSHOT_EVERY:
+            self._updates_since_snapshot = 0
+            self._snapshot_due = True
+        elif not self._snapshot_due:
+            email_bytes = email.encode('utf-8')
+            self._pending_records.append(_JOURNAL_RECORD.pack(
+                bool(success), int(message_length), float(first_packet_delay),
+                int(generation_tokens), float(generation_time), stats.last_updated,
+                len(email_bytes)
+            ) + email_bytes)
+    
+    def _apply_result(self, email: str, success: bool,
+                      message_length: int = 0,
+                      first_packet_delay: float = 0.0,
+                      generation_tokens: int = 0,
+                      generation_time: float = 0.0) -> AccountStats:
+        """将一次结果计入内存中的统计"""
         if email not in self.account_stats:
             self.account_stats[email] = AccountStats(email=email)
         
@@ -265,21 +786,23 @@ class AdvancedKLUCBOptimizer:
             self.failed_accounts.add(email)
         
         self.global_attempts += 1
-        
-        if self.global_attempts % 5 == 0:
-            self.save_stats()
+        return stats
     
     def reset_failed_accounts(self):
         """重置失败账号集合，开始新一轮"""
         self.failed_accounts.clear()
+        self._score_cache.clear()
+        self._score_cache_keys.clear()
     
     def get_performance_report(self) -> Dict:
         """获取性能报告"""
         if not self.account_stats:
             return {"message": "暂无统计数据"}
         
+        log_N = math.log(max(self.global_attempts, 1))
+        scores = {email: self.calculate_ultimate_score(email, log_N=log_N) for email in self.account_stats}
         sorted_stats = sorted(self.account_stats.items(), 
-                            key=lambda x: self.calculate_ultimate_score(x[0]), reverse=True)
+                            key=lambda x: scores[x[0]], reverse=True)
         
         report = {
             "total_accounts": len(self.account_stats),
@@ -298,7 +821,7 @@ class AdvancedKLUCBOptimizer:
                 "avg_first_packet_delay": round(stats.avg_first_packet_delay, 2),
                 "generation_speed": round(stats.generation_speed, 1),
                 "avg_message_length": round(stats.avg_message_length, 0),
-                "ultimate_score": round(self.calculate_ultimate_score(email), 3),
+                "ultimate_score": round(scores[email], 3),
                 "is_failed_this_round": email in self.failed_accounts
             })
         
@@ -313,7 +836,6 @@ class AdvancedKLUCBOptimizer:
 class Account:
     email: str
     password: str
-    password_hash: str = field(init=False)
     token: str = ""
     token_expires: float = 0
     user_id: str = ""
@@ -321,10 +843,13 @@ class Account:
     is_busy: bool = False
     is_logged_in: bool = False
     is_initializing: bool = False
+    is_available: bool = False  # 是否在账号池的 available_accounts 中
     login_attempts: int = 0
     
-    def __post_init__(self):
-        self.password_hash = hashlib.sha256(self.password.encode('utf-8')).hexdigest()
+    @functools.cached_property
+    def password_hash(self) -> str:
+        """登录时才计算，未参与登录的账号不做哈希"""
+        return hashlib.sha256(self.password.encode('utf-8')).hexdigest()
 
 @dataclass
 class SessionInfo:
@@ -349,13 +874,12 @@ class FileUtils:
     
     @staticmethod
     def get_mime_type(filename: str) -> str:
-        ext = os.path.splitext(filename)[1].lower()
-        if ext in EXTENSION_TO_MIME:
-            return EXTENSION_TO_MIME[ext]
-        mime_type, _ = mimetypes.guess_type(filename)
-        return mime_type or 'application/octet-stream'
+        i = filename.rfind('.')
+        ext = filename[i:].lower() if i >= 0 else ''
+        return _EXT_TO_MIME.get(ext) or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
     
     @staticmethod
+    @functools.lru_cache(maxsize=256)
     def get_file_category(content_type: str) -> tuple:
         if content_type in FILE_TYPE_MAPPING:
             file_type = FILE_TYPE_MAPPING[content_type]
@@ -375,22 +899,25 @@ class FileUtils:
     
     @staticmethod
     def is_url(path: str) -> bool:
-        return path.startswith(('http://', 'https://'))
+        return path[:8] == 'https://' or path[:7] == 'http://'
     
     @staticmethod
-    def get_filename_from_url(url: str) -> str:
-        parsed = urlparse(url)
-        path = parsed.path
-        if path:
-            filename = os.path.basename(path)
-            if filename and '.' in filename:
-                return filename
-        return f"url_file_{int(time.time())}.jpg"
+    def get_filename_from_url(url: Union[str, URL]) -> Optional[str]:
+        """返回 URL 路径的最后一段（需带扩展名），否则返回 None"""
+        if not isinstance(url, URL):
+            url = URL(url)
+        filename = url.name
+        if filename and '.' in filename:
+            return filename
+        return None
     
     @staticmethod
     async def get_url_file_info(session: aiohttp.ClientSession, url: str, user_id: str) -> FileInfo:
+        filename = None
         try:
-            async with session.head(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+            parsed_url = URL(url)
+            filename = FileUtils.get_filename_from_url(parsed_url)
+            async with session.head(parsed_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
                 content_type = response.headers.get('Content-Type', 'image/jpeg')
                 if ';' in content_type:
                     content_type = content_type.split(';')[0].strip()
@@ -398,17 +925,17 @@ class FileUtils:
                 content_length = response.headers.get('Content-Length')
                 size = int(content_length) if content_length else 0
                 
-                filename = FileUtils.get_filename_from_url(url)
-                
-                if filename != f"url_file_{int(time.time())}.jpg":
+                if filename:
                     inferred_type = FileUtils.get_mime_type(filename)
                     if inferred_type != 'application/octet-stream':
                         content_type = inferred_type
+                else:
+                    filename = f"url_file_{int(time.time())}.jpg"
                 
                 file_type, file_class = FileUtils.get_file_category(content_type)
                 
                 return FileInfo(
-                    file_id=str(uuid.uuid4()),
+                    file_id=_uuid_pool.next(),
                     file_url=url,
                     filename=filename,
                     size=size,
@@ -418,9 +945,10 @@ class FileUtils:
                     file_class=file_class
                 )
         except Exception as e:
-            filename = FileUtils.get_filename_from_url(url)
+            if not filename:
+                filename = f"url_file_{int(time.time())}.jpg"
             return FileInfo(
-                file_id=str(uuid.uuid4()),
+                file_id=_uuid_pool.next(),
                 file_url=url,
                 filename=filename,
                 size=0,
@@ -435,66 +963,135 @@ class AsyncAccountPool:
     def __init__(self, debug: bool = False):
         self.accounts: List[Account] = []
         self.available_accounts: List[Account] = []
-        self.lock = None  # 延迟创建
+        self.lock: Optional[Lock] = None  # 在 initialize() 中创建
         self.debug = debug
         self.session = None
         self.refresh_task = None
+        self.stats_flush_task = None
         self.running = True
         self.initialization_task = None
+        # pause() 时后台初始化尚未完成，恢复时需要重新启动
+        self._resume_initialization = False
         self.initialized_count = 0
+        # 状态计数器，随状态切换实时维护，get_status 直接读取
+        self._n_logged_in = 0
+        self._n_busy = 0
+        self._n_initializing = 0
         self.kl_ucb_optimizer = AdvancedKLUCBOptimizer(debug=debug)
         self._initialized = False
         self._init_accounts()
     
-    def _debug_print(self, message: str):
-        if self.debug:
-            pass
+    def _set_logged_in(self, account: Account, value: bool):
+        if account.is_logged_in != value:
+            account.is_logged_in = value
+            self._n_logged_in += 1 if value else -1
+    
+    def _set_busy(self, account: Account, value: bool):
+        if account.is_busy != value:
+            account.is_busy = value
+            # _n_busy 只统计仍在 available_accounts 中的忙碌账号
+            if account.is_available:
+                self._n_busy += 1 if value else -1
+    
+    def _add_available(self, account: Account) -> bool:
+        """加入可用列表，已在列表中时返回 False"""
+        if account.is_available:
+            return False
+        account.is_available = True
+        self.available_accounts.append(account)
+        if account.is_busy:
+            self._n_busy += 1
+        return True
+    
+    def _remove_available(self, account: Account):
+        """移出可用列表（例如刷新登录失败），忙碌的账号同时移出忙碌计数"""
+        if not account.is_available:
+            return
+        account.is_available = False
+        self.available_accounts.remove(account)
+        if account.is_busy:
+            self._n_busy -= 1
+    
+    def _set_initializing(self, account: Account, value: bool):
+        if account.is_initializing != value:
+            account.is_initializing = value
+            self._n_initializing += 1 if value else -1
     
     def _init_accounts(self):
         for email in ACCOUNTS:
             self.accounts.append(Account(email, email))
     
-    async def _ensure_lock(self):
-        """确保锁已创建"""
-        if self.lock is None:
-            self.lock = Lock()
-    
     async def initialize(self, session: aiohttp.ClientSession):
         if self._initialized:
+            # 客户端重建会话后更新引用，并恢复 pause() 停下的后台任务
+            self.session = session
+            self._start_background_tasks()
             return
             
-        await self._ensure_lock()
+        self.lock = Lock()
         self.session = session
-        self._start_background_initialization()
-        self._start_refresh_task()
+        self._resume_initialization = True
+        self._start_background_tasks()
         self._initialized = True
     
+    def _start_background_tasks(self):
+        """启动尚未运行的后台任务（shutdown 之后不再启动）"""
+        if not self.running:
+            return
+        if self._resume_initialization and self.initialization_task is None:
+            self._resume_initialization = False
+            self._start_background_initialization()
+        if self.refresh_task is None:
+            self._start_refresh_task()
+        if self.stats_flush_task is None:
+            self.stats_flush_task = asyncio.create_task(self.kl_ucb_optimizer.flush_worker())
+    
+    async def _cancel_background_tasks(self):
+        """取消并等待所有后台任务结束"""
+        for task in (self.stats_flush_task, self.refresh_task, self.initialization_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.stats_flush_task = None
+        self.refresh_task = None
+        self.initialization_task = None
+    
+    async def pause(self):
+        """会话关闭前暂停后台任务，避免它们用已关闭的会话登录失败；再次 initialize() 时恢复"""
+        if self.initialization_task is not None and not self.initialization_task.done():
+            self._resume_initialization = True
+        await self._cancel_background_tasks()
+        self.session = None
+    
     def _start_background_initialization(self):
         """启动后台初始化任务"""
         self.initialization_task = asyncio.create_task(self._background_initialization())
     
     async def _background_initialization(self):
         """后台逐个初始化账号"""
+        assert self.lock is not None
         semaphore = Semaphore(3)  # 限制并发登录数
         
         async def login_single_account(account):
             async with semaphore:
-                account.is_initializing = True
+                self._set_initializing(account, True)
                 success = await self._login_account(account)
-                account.is_initializing = False
+                self._set_initializing(account, False)
                 
                 if success:
-                    await self._ensure_lock()
                     async with self.lock:
-                        if account not in self.available_accounts:
-                            self.available_accounts.append(account)
+                        if self._add_available(account):
                             self.initialized_count += 1
                 
                 return success
         
-        # 分批初始化，优先处理前几个账号
-        for i in range(0, len(self.accounts), 5):
-            batch = self.accounts[i:i+5]
+        # 分批初始化，优先处理前几个账号；暂停后恢复时跳过已登录的账号
+        pending = [account for account in self.accounts if not account.is_logged_in]
+        for i in range(0, len(pending), 5):
+            batch = pending[i:i+5]
             tasks = [login_single_account(account) for account in batch]
             await asyncio.gather(*tasks, return_exceptions=True)
             
@@ -507,33 +1104,19 @@ class AsyncAccountPool:
         
         for attempt in range(max_retries):
             try:
-                headers = {
-                    "Host": "chat.qwen.ai",
-                    "Content-Type": "application/json; charset=UTF-8",
-                    "User-Agent": "Mozilla/5.0 (Linux; Android 10; BAH3-W09) AppleWebKit/537.36",
-                    "Accept": "*/*",
-                    "Origin": "https://chat.qwen.ai",
-                    "Referer": "https://chat.qwen.ai/auth?action=signin",
-                }
-                
-                data = {
-                    "email": account.email,
-                    "password": account.password_hash
-                }
-                
                 async with self.session.post(
                     "https://chat.qwen.ai/api/v1/auths/signin",
-                    headers=headers,
-                    json=data,
-                    timeout=aiohttp.ClientTimeout(total=10)
+                    headers=_STATIC_LOGIN_HEADERS,
+                    data=_dumps({"email": account.email, "password": account.password_hash}),
+                    timeout=_LOGIN_TIMEOUT
                 ) as response:
                     
                     if response.status == 200:
-                        result = await response.json()
+                        result = await response.json(loads=_loads)
                         account.token = result.get("token", "")
                         account.token_expires = result.get("expires_at", 0)
                         account.user_id = result.get("id", "")
-                        account.is_logged_in = True
+                        self._set_logged_in(account, True)
                         account.login_attempts = 0
                         return True
                     else:
@@ -545,7 +1128,7 @@ class AsyncAccountPool:
             if attempt < max_retries - 1:
                 await asyncio.sleep(retry_delay)
         
-        account.is_logged_in = False
+        self._set_logged_in(account, False)
         account.login_attempts += 1
         return False
     
@@ -553,35 +1136,31 @@ class AsyncAccountPool:
         self.refresh_task = asyncio.create_task(self._token_refresh_worker())
     
     async def _token_refresh_worker(self):
+        assert self.lock is not None
         while self.running:
             try:
                 current_time = time.time()
                 accounts_to_refresh = []
+                failed_accounts = []
                 
-                await self._ensure_lock()
+                # 单次遍历同时收集待刷新和待重试的账号
                 async with self.lock:
-                    for account in self.available_accounts:
-                        if account.is_logged_in and account.token_expires <= current_time + 600:
-                            accounts_to_refresh.append(account)
+                    for account in self.accounts:
+                        if account.is_logged_in:
+                            if account.token_expires <= current_time + 600:
+                                accounts_to_refresh.append(account)
+                        elif account.login_attempts < 3 and not account.is_initializing:
+                            failed_accounts.append(account)
                 
                 for account in accounts_to_refresh:
                     if not await self._login_account(account):
-                        await self._ensure_lock()
                         async with self.lock:
-                            if account in self.available_accounts:
-                                self.available_accounts.remove(account)
-                
-                await self._ensure_lock()
-                async with self.lock:
-                    failed_accounts = [acc for acc in self.accounts 
-                                     if not acc.is_logged_in and acc.login_attempts < 3 and not acc.is_initializing]
+                            self._remove_available(account)
                 
                 for account in failed_accounts[:3]:  # 限制并发重试数
                     if await self._login_account(account):
-                        await self._ensure_lock()
                         async with self.lock:
-                            if account not in self.available_accounts:
-                                self.available_accounts.append(account)
+                            self._add_available(account)
                 
                 await asyncio.sleep(30)
                 
@@ -593,7 +1172,6 @@ class AsyncAccountPool:
         start_time = time.time()
         
         while time.time() - start_time < wait_timeout:
-            await self._ensure_lock()
             async with self.lock:
                 idle_accounts = [acc for acc in self.available_accounts 
                                if not acc.is_busy and acc.is_logged_in]
@@ -605,7 +1183,7 @@ class AsyncAccountPool:
                     optimal_account = self.kl_ucb_optimizer.select_optimal_account(idle_accounts, message_length)
                     
                     if optimal_account:
-                        optimal_account.is_busy = True
+                        self._set_busy(optimal_account, True)
                         optimal_account.last_used = time.time()
                         return optimal_account
             
@@ -623,9 +1201,8 @@ class AsyncAccountPool:
                             generation_tokens: int = 0,
                             generation_time: float = 0.0):
         """释放账号并更新统计"""
-        await self._ensure_lock()
         async with self.lock:
-            account.is_busy = False
+            self._set_busy(account, False)
             
             self.kl_ucb_optimizer.update_account_result(
                 account.email, success, message_length, 
@@ -633,40 +1210,48 @@ class AsyncAccountPool:
             )
     
     async def get_status(self) -> Dict:
-        await self._ensure_lock()
         async with self.lock:
-            total = len(self.accounts)
-            logged_in = len([a for a in self.accounts if a.is_logged_in])
-            available = len([a for a in self.available_accounts if not a.is_busy])
-            busy = len([a for a in self.available_accounts if a.is_busy])
-            initializing = len([a for a in self.accounts if a.is_initializing])
-            
             return {
-                "total_accounts": total,
-                "logged_in": logged_in,
-                "available": available,
-                "busy": busy,
-                "initializing": initializing,
+                "total_accounts": len(self.accounts),
+                "logged_in": self._n_logged_in,
+                "available": len(self.available_accounts) - self._n_busy,
+                "busy": self._n_busy,
+                "initializing": self._n_initializing,
                 "initialized_count": self.initialized_count
             }
     
     async def shutdown(self):
         self.running = False
-        if self.refresh_task:
-            self.refresh_task.cancel()
-            try:
-                await self.refresh_task
-            except asyncio.CancelledError:
-                pass
+        await self._cancel_background_tasks()
         
-        if self.initialization_task:
-            self.initialization_task.cancel()
-            try:
-                await self.initialization_task
-            except asyncio.CancelledError:
-                pass
-        
-        self.kl_ucb_optimizer.save_stats()
+        await self.kl_ucb_optimizer.close()
+
+@functools.lru_cache(maxsize=32)
+def _hmac_sha1_template(access_key_secret: str) -> hmac.HMAC:
+    """按密钥缓存已完成密钥扩展的 HMAC-SHA1 对象，使用时 copy()"""
+    return hmac.new(access_key_secret.encode('utf-8'), b'', hashlib.sha1)
+
+_gmt_cache: Tuple[int, str] = (0, '')
+
+def _gmt_now() -> str:
+    """当前 GMT 时间字符串（RFC 1123），同一秒内复用"""
+    global _gmt_cache
+    now = int(time.time())
+    if _gmt_cache[0] != now:
+        _gmt_cache = (now, formatdate(now, usegmt=True))
+    return _gmt_cache[1]
+
+async def _iter_file_chunks(file_path: str, chunk_size: int = 1 << 20) -> AsyncGenerator[bytes, None]:
+    """在线程中分块读取文件，避免整文件读入内存并阻塞事件循环"""
+    f = await asyncio.to_thread(open, file_path, 'rb')
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
 
 class AdvancedOSSUploader:
     
@@ -676,10 +1261,6 @@ class AdvancedOSSUploader:
         self.max_retries = 3
         self.timeout = 60
     
-    def _debug_print(self, message: str):
-        if self.debug:
-            pass
-    
     def _generate_oss_authorization(self, 
                                   method: str, 
                                   content_type: str, 
@@ -691,45 +1272,67 @@ class AdvancedOSSUploader:
         
         canonicalized_oss_headers = ""
         if oss_headers:
-            sorted_headers = sorted(oss_headers.items())
-            canonicalized_oss_headers = "\n".join([f"{k}:{v}" for k, v in sorted_headers]) + "\n"
+            canonicalized_oss_headers = "\n".join(f"{k}:{v}" for k, v in sorted(oss_headers.items())) + "\n"
         
         string_to_sign = f"{method}\n\n{content_type}\n{date}\n{canonicalized_oss_headers}{resource}"
         
-        signature = base64.b64encode(
-            hmac.new(
-                access_key_secret.encode('utf-8'),
-                string_to_sign.encode('utf-8'),
-                hashlib.sha1
-            ).digest()
-        ).decode('utf-8')
+        mac = _hmac_sha1_template(access_key_secret).copy()
+        mac.update(string_to_sign.encode('utf-8'))
+        signature = base64.b64encode(mac.digest()).decode('utf-8')
         
         return f"OSS {access_key_id}:{signature}"
     
-    async def upload_file_with_retry(self, file_path: str, upload_info: Dict) -> str:
+    async def upload_file_with_retry(self, file_path: str, upload_info: Dict, file_size: int) -> str:
         last_error = None
+        connection_lost = False
         
         for attempt in range(self.max_retries + 1):
             try:
                 if attempt > 0:
+                    # 首次重试最多等 500ms，之后指数退避并加抖动，避免同时重试
                     delay = min(1000 * (2 ** (attempt - 1)), 3000) / 1000
-                    await asyncio.sleep(delay)
+                    if attempt == 1:
+                        delay = min(delay, 0.5)
+                    await asyncio.sleep(delay * (1 + random.random() * 0.3))
+                    
+                    if connection_lost:
+                        await self._prime_connection(upload_info)
                 
-                return await self._upload_with_sts_put(file_path, upload_info)
+                return await self._upload_with_sts_put(file_path, upload_info, file_size)
+                
+            except (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError) as e:
+                last_error = e
+                connection_lost = True
+                
+                if attempt == self.max_retries:
+                    return upload_info['file_url']
                 
             except Exception as e:
                 last_error = e
+                connection_lost = False
                 
                 if attempt == self.max_retries:
                     return upload_info['file_url']
         
         return upload_info['file_url']
     
-    async def _upload_with_sts_put(self, file_path: str, upload_info: Dict) -> str:
-        filename = os.path.basename(file_path)
+    async def _prime_connection(self, upload_info: Dict):
+        """连接断开后对目标对象发一次 HEAD，预热到 OSS 的新连接
         
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
+        出错的连接已由 aiohttp 丢弃，这里只负责提前完成 TCP/TLS 握手。
+        """
+        try:
+            async with self.session.head(
+                upload_info['file_url'],
+                timeout=aiohttp.ClientTimeout(total=5)
+            ):
+                pass
+        except Exception as e:
+            pass
+    
+    async def _upload_with_sts_put(self, file_path: str, upload_info: Dict, file_size: int) -> str:
+        """file_size 由调用方在工作线程中取得，这里不再 stat"""
+        filename = os.path.basename(file_path)
         
         content_type = FileUtils.get_mime_type(filename)
         
@@ -737,7 +1340,7 @@ class AdvancedOSSUploader:
         bucket_host = parsed_url.netloc
         object_key = upload_info['file_path']
         
-        gmt_date = datetime.now(timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+        gmt_date = _gmt_now()
         
         oss_headers = {
             'x-oss-security-token': upload_info['security_token']
@@ -760,7 +1363,7 @@ class AdvancedOSSUploader:
             "Host": bucket_host,
             "Date": gmt_date,
             "Content-Type": content_type,
-            "Content-Length": str(len(file_content)),
+            "Content-Length": str(file_size),
             "Authorization": authorization,
             "x-oss-security-token": upload_info['security_token'],
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
@@ -773,7 +1376,7 @@ class AdvancedOSSUploader:
         try:
             async with self.session.put(
                 upload_url,
-                data=file_content,
+                data=_iter_file_chunks(file_path),
                 headers=headers,
                 timeout=aiohttp.ClientTimeout(total=self.timeout)
             ) as response:
@@ -786,12 +1389,59 @@ class AdvancedOSSUploader:
         except Exception as e:
             raise
 
+# ============= 共享连接池 =============
+
+# 连接池与事件循环绑定，和全局客户端一样按事件循环各持有一个
+_shared_connectors: Dict[int, aiohttp.TCPConnector] = {}
+
+def _get_shared_connector(limit: int) -> aiohttp.TCPConnector:
+    """返回当前事件循环上的共享连接池，同一循环内的所有客户端实例复用同一组连接
+    
+    检查与创建之间没有 await，单个事件循环内无需加锁。
+    """
+    loop = asyncio.get_running_loop()
+    # 已关闭事件循环上的连接池无法再使用，也无法在原循环上关闭，直接丢弃引用
+    for loop_id, stale in list(_shared_connectors.items()):
+        stale_loop = getattr(stale, '_loop', None)
+        if stale_loop is not None and stale_loop.is_closed():
+            del _shared_connectors[loop_id]
+    connector = _shared_connectors.get(id(loop))
+    # 循环关闭后 id 可能被新循环复用，旧连接池已无法在原循环上关闭，直接替换
+    if (connector is None or connector.closed
+            or getattr(connector, '_loop', loop) is not loop):
+        # 几乎所有请求都发往 chat.qwen.ai，单主机上限与总上限一致
+        connector = _shared_connectors[id(loop)] = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit,
+            keepalive_timeout=30,
+            enable_cleanup_closed=True
+        )
+    return connector
+
+async def cleanup_shared_connector():
+    """关闭当前事件循环的共享连接池（进程退出时调用）"""
+    connector = _shared_connectors.pop(id(asyncio.get_running_loop()), None)
+    if connector and not connector.closed:
+        try:
+            await connector.close()
+        except Exception:
+            pass
+
 class AsyncQwenClient:
     
-    def __init__(self, max_concurrent_requests: int = 100, debug: bool = False):
+    def __init__(self, max_concurrent_requests: int = 100, debug: bool = False,
+                 http2: Optional[bool] = None):
         self.account_pool = AsyncAccountPool(debug=debug)
+        # 为 None 时由环境变量 QWEN_HTTP2=1 决定是否让流式聊天走 HTTP/2
+        if http2 is None:
+            http2 = os.environ.get("QWEN_HTTP2", "") in ("1", "true", "True")
+        self.http2 = http2
+        self._http2_client = None
         self.session_lock = None  # 延迟创建
-        self.semaphore = None  # 延迟创建
+        # 并发准入：Condition 保护的计数器，上限可通过 set_limit 动态调整
+        self._cond = None  # 延迟创建
+        self._in_flight = 0
+        self._limit = max_concurrent_requests
         self.connector = None
         self.session = None
         self._closing = False
@@ -801,18 +1451,34 @@ class AsyncQwenClient:
         self._init_lock = None  # 延迟创建
         self.max_concurrent_requests = max_concurrent_requests
         
-    def _debug_print(self, message: str):
-        if self.debug:
-            pass
-    
     async def _ensure_async_primitives(self):
         """确保异步原语已创建"""
         if self._init_lock is None:
             self._init_lock = asyncio.Lock()
         if self.session_lock is None:
             self.session_lock = Lock()
-        if self.semaphore is None:
-            self.semaphore = Semaphore(self.max_concurrent_requests)
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+    
+    async def set_limit(self, new_limit: int) -> None:
+        """动态调整最大并发请求数"""
+        await self._ensure_async_primitives()
+        async with self._cond:
+            self._limit = max(1, new_limit)
+            self._cond.notify_all()
+    
+    @contextlib.asynccontextmanager
+    async def _slot(self):
+        """占用一个并发名额"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self._limit)
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._in_flight -= 1
+                self._cond.notify(1)
         
     async def ensure_initialized(self):
         """确保客户端已初始化"""
@@ -833,16 +1499,27 @@ class AsyncQwenClient:
         
         # 确保在当前事件循环中创建连接
         try:
-            self.connector = aiohttp.TCPConnector(
-                limit=100, 
-                limit_per_host=30,
-                keepalive_timeout=30,
-                enable_cleanup_closed=True
-            )
+            self.connector = _get_shared_connector(self.max_concurrent_requests)
             self.session = aiohttp.ClientSession(
                 connector=self.connector,
-                timeout=aiohttp.ClientTimeout(total=30)
+                connector_owner=False,
+                timeout=aiohttp.ClientTimeout(total=30),
+                json_serialize=_json_serialize
             )
+            if self.http2 and httpx is not None:
+                try:
+                    # 所有流式请求复用少量 HTTP/2 连接多路传输
+                    self._http2_client = httpx.AsyncClient(
+                        http2=True,
+                        limits=httpx.Limits(
+                            max_connections=self.max_concurrent_requests,
+                            max_keepalive_connections=self.max_concurrent_requests
+                        ),
+                        timeout=httpx.Timeout(120)
+                    )
+                except ImportError:
+                    # 未安装 h2，回退到 aiohttp
+                    self._http2_client = None
             self.oss_uploader = AdvancedOSSUploader(self.session, self.debug)
             await self.account_pool.initialize(self.session)
             self._initialized = True
@@ -858,15 +1535,33 @@ class AsyncQwenClient:
                 await self.session.close()
         except Exception:
             pass
-            
+        
         try:
-            if self.connector and not self.connector.closed:
-                await self.connector.close()
+            if self._http2_client is not None:
+                await self._http2_client.aclose()
         except Exception:
             pass
+        self._http2_client = None
+        
+        # 连接池为模块共享，不随单个客户端关闭
+        self.connector = None
             
+    async def close_session(self):
+        """只关闭会话：账号池暂停后台任务但保留登录状态和统计，之后可以直接重新初始化"""
+        try:
+            await self.account_pool.pause()
+        except Exception as e:
+            pass
+        
+        await self._cleanup_resources()
+        self._initialized = False
+    
     async def close(self):
-        """关闭客户端"""
+        """关闭客户端（等同于 shutdown）"""
+        await self.shutdown()
+    
+    async def shutdown(self):
+        """完全关闭客户端：停止账号池后台任务、保存统计并关闭会话"""
         if self._closing:
             return
         self._closing = True
@@ -876,40 +1571,29 @@ class AsyncQwenClient:
         except Exception as e:
             pass
         
-        await self._cleanup_resources()
-        await asyncio.sleep(0.1)
-        self._initialized = False
+        await self.close_session()
     
-    async def _create_new_chat(self, token: str, model: str = "qwen3-coder-plus") -> str:
+    async def _create_new_chat(self, token: str, model: str = "qwen3-coder-plus",
+                               now_ms: Optional[int] = None) -> str:
         """创建新对话"""
-        headers = {
-            "authorization": f"Bearer {token}",
-            "content-type": "application/json; charset=UTF-8",
-            "source": "web",
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "origin": "https://chat.qwen.ai",
-            "referer": "https://chat.qwen.ai/",
-            "accept": "application/json",
-            "accept-language": "zh-CN,zh;q=0.9",
-            "x-request-id": str(uuid.uuid4()),
-        }
+        headers = {**_NEW_CHAT_HEADERS, "authorization": _AUTH_FMT % token, "x-request-id": _uuid_pool.next_hex()}
         
         payload = {
             "title": "新建对话",
             "models": [model],
             "chat_mode": "normal",
             "chat_type": "t2t",
-            "timestamp": int(time.time() * 1000)
+            "timestamp": now_ms if now_ms is not None else int(time.time() * 1000)
         }
         
         async with self.session.post(
             "https://chat.qwen.ai/api/v2/chats/new",
-            json=payload,
+            data=_dumps(payload),
             headers=headers,
             timeout=aiohttp.ClientTimeout(total=15)
         ) as response:
             response.raise_for_status()
-            data = await response.json()
+            data = await response.json(loads=_loads)
             
             if not data.get("success"):
                 raise Exception(f"创建对话失败: {data}")
@@ -920,32 +1604,24 @@ class AsyncQwenClient:
             
             return chat_id
     
-    async def _get_upload_credentials_with_retry(self, filename: str, filesize: int, token: str) -> Dict:
+    async def _get_upload_credentials_with_retry(self, filename: str, filesize: int, token: str,
+                                                 file_type: Optional[str] = None) -> Dict:
         """获取上传凭据（重试版本）"""
         for attempt in range(3):
             try:
-                return await self._get_upload_credentials(filename, filesize, token)
+                return await self._get_upload_credentials(filename, filesize, token, file_type)
             except Exception as e:
                 if attempt == 2:
                     raise
                 await asyncio.sleep(1)
     
-    async def _get_upload_credentials(self, filename: str, filesize: int, token: str) -> Dict:
+    async def _get_upload_credentials(self, filename: str, filesize: int, token: str,
+                                      file_type: Optional[str] = None) -> Dict:
         """获取上传凭据"""
-        headers = {
-            "authorization": f"Bearer {token}",
-            "content-type": "application/json; charset=UTF-8",
-            "source": "web",
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "origin": "https://chat.qwen.ai",
-            "referer": "https://chat.qwen.ai/",
-            "accept": "*/*",
-            "accept-language": "zh-CN,zh;q=0.9",
-            "x-request-id": str(uuid.uuid4()),
-        }
+        headers = {**_STS_HEADERS, "authorization": _AUTH_FMT % token, "x-request-id": _uuid_pool.next_hex()}
         
-        content_type = FileUtils.get_mime_type(filename)
-        file_type, _ = FileUtils.get_file_category(content_type)
+        if file_type is None:
+            file_type, _ = FileUtils.get_file_category(FileUtils.get_mime_type(filename))
         
         payload = {
             "filename": filename,
@@ -958,42 +1634,60 @@ class AsyncQwenClient:
             "https://chat.qwen.ai/api/v1/files/getstsToken"
         ]
         
+        # v2 与 v1 同时请求，取最先成功的结果（同时完成时优先 v2），其余请求取消
+        body = _dumps(payload)
+        tasks = [
+            asyncio.create_task(self._request_upload_credentials(api_url, body, headers))
+            for api_url in api_urls
+        ]
         last_error = None
-        for api_url in api_urls:
-            try:
-                async with self.session.post(
-                    api_url,
-                    json=payload, 
-                    headers=headers,
-                    timeout=aiohttp.ClientTimeout(total=15)
-                ) as response:
-                    
-                    if response.status != 200:
-                        error_text = await response.text()
-                        raise Exception(f"获取上传凭据失败，状态码: {response.status}, 响应: {error_text}")
-                    
-                    data = await response.json()
-                    
-                    if "data" in data:
-                        return data["data"]
-                    elif all(key in data for key in ["access_key_id", "access_key_secret", "security_token"]):
-                        return data
-                    else:
-                        raise Exception(f"上传凭据响应格式异常: {data}")
-                        
-            except Exception as e:
-                last_error = e
-                continue
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done:
+                        if task.exception() is None:
+                            return task.result()
+                        last_error = task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
         
         raise last_error or Exception("所有API都失败")
     
+    async def _request_upload_credentials(self, api_url: str, body: bytes, headers: Dict) -> Dict:
+        """向单个接口请求上传凭据"""
+        async with self.session.post(
+            api_url,
+            data=body,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=15)
+        ) as response:
+            
+            if response.status != 200:
+                error_text = await response.text()
+                raise Exception(f"获取上传凭据失败，状态码: {response.status}, 响应: {error_text}")
+            
+            data = await response.json(loads=_loads)
+            
+            if "data" in data:
+                return data["data"]
+            elif all(key in data for key in ["access_key_id", "access_key_secret", "security_token"]):
+                return data
+            else:
+                raise Exception(f"上传凭据响应格式异常: {data}")
+    
     async def upload_file(self, file_path: str, account: Account) -> FileInfo:
         """上传文件"""
-        if not os.path.exists(file_path):
+        # 一次 stat 同时完成存在性检查和取文件大小，放到线程中避免阻塞事件循环
+        try:
+            st = await asyncio.to_thread(os.stat, file_path)
+        except FileNotFoundError:
             raise Exception(f"文件不存在: {file_path}")
         
         filename = os.path.basename(file_path)
-        filesize = os.path.getsize(file_path)
+        filesize = st.st_size
         content_type = FileUtils.get_mime_type(filename)
         file_type, file_class = FileUtils.get_file_category(content_type)
         
@@ -1006,7 +1700,7 @@ class AsyncQwenClient:
         
         try:
             upload_info = await self._get_upload_credentials_with_retry(
-                filename, filesize, account.token
+                filename, filesize, account.token, file_type
             )
             
             required_fields = ["access_key_id", "access_key_secret", "security_token", "file_url", "file_path"]
@@ -1014,10 +1708,10 @@ class AsyncQwenClient:
             if missing_fields:
                 raise Exception(f"上传凭据缺少字段: {missing_fields}")
             
-            file_url = await self.oss_uploader.upload_file_with_retry(file_path, upload_info)
+            file_url = await self.oss_uploader.upload_file_with_retry(file_path, upload_info, filesize)
             
             return FileInfo(
-                file_id=upload_info.get('file_id', str(uuid.uuid4())),
+                file_id=upload_info.get('file_id', _uuid_pool.next()),
                 file_url=file_url,
                 filename=filename,
                 size=filesize,
@@ -1030,11 +1724,11 @@ class AsyncQwenClient:
         except Exception as e:
             raise Exception(f"文件上传失败 {filename}: {str(e)}")
     
-    def _build_file_object(self, file_info: FileInfo) -> Dict:
+    def _build_file_object(self, file_info: FileInfo, now_ms: Optional[int] = None) -> Dict:
         """构建文件对象"""
-        current_time = int(time.time() * 1000)
-        item_id = str(uuid.uuid4())
-        upload_task_id = str(uuid.uuid4())
+        current_time = now_ms if now_ms is not None else int(time.time() * 1000)
+        item_id = _uuid_pool.next()
+        upload_task_id = _uuid_pool.next()
         
         if file_info.file_class == 'vision' and file_info.content_type.startswith('image/'):
             show_type = 'image'
@@ -1077,58 +1771,45 @@ class AsyncQwenClient:
             "uploadTaskId": upload_task_id
         }
     
-    def _build_payload(self, message: str, chat_id: str, model: str, files: List[Dict] = None) -> Dict:
-        """构建请求载荷"""
-        if files is None:
-            files = [] 
-        return {
-            "stream": True,
-            "incremental_output": True,
-            "chat_id": chat_id,
-            "chat_mode": "normal",
-            "model": model,
-            "parent_id": None,
-            "messages": [{
-                "fid": str(uuid.uuid4()),
-                "parentId": None,
-                "childrenIds": [str(uuid.uuid4())],
-                "role": "user",
-                "content": message,
-                "user_action": "chat",
-                "files": files,
-                "timestamp": int(time.time() * 1000),
-                "models": [model],
-                "chat_type": "t2t",
-                "feature_config": {
-                    "thinking_enabled": False,
-                    "output_schema": "phase",
-                    "thinking_budget": 1024,
-                    "mcp": {}
-                },
-            "generate_cfg": {
-                "max_input_tokens": 1048576,
-                "max_tokens": 1048576,
-                "max_new_tokens": 1048576-len(message),
-                "seed": -1,
-                "function_choice": "none",
-                "system_message":" ",
-                "fncall_prompt_type":"qwen",
-                "incremental_output": True,
-                "skip_stopword_postproc": False,
-                "max_retries": 3,
-                "cache_dir":"./cache"
-            },
-                "extra": {"meta": {"subChatType": "t2t"}},
-                "sub_chat_type": "t2t",
-                "parent_id": None,
-            }],
-            "timestamp": int(time.time() * 1000),
-        }
+    async def _resolve_file(self, file_path_or_url: str, account: Account,
+                            semaphore: Semaphore, now_ms: Optional[int] = None) -> Dict:
+        """处理单个文件或 URL，返回文件对象"""
+        async with semaphore:
+            if FileUtils.is_url(file_path_or_url):
+                file_info = await FileUtils.get_url_file_info(
+                    self.session, file_path_or_url, account.user_id
+                )
+            else:
+                file_info = await self.upload_file(file_path_or_url, account)
+        return self._build_file_object(file_info, now_ms)
+    
+    def _build_payload(self, message: str, chat_id: str, model: str, files: List[Dict] = None,
+                       now_ms: Optional[int] = None) -> bytes:
+        """构建请求载荷（已序列化的 JSON bytes）"""
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        model_json = _dumps(model)
+        timestamp = str(now_ms).encode()
+        return _render_template(_PAYLOAD_TEMPLATE, {
+            "CHAT_ID": _dumps(chat_id),
+            "MODEL": model_json,
+            "FID": _dumps(_uuid_pool.next()),
+            "CHILD_ID": _dumps(_uuid_pool.next()),
+            "CONTENT": _dumps(message),
+            "FILES": _dumps(files) if files else b"[]",
+            "TIMESTAMP": timestamp,
+            "MAX_NEW_TOKENS": str(1048576 - len(message)).encode(),
+        })
     
     def _estimate_tokens(self, text: str) -> int:
         """估算token数量（简单方法）"""
-        chinese_chars = len(re.findall(r'[\u4e00-\u9fff]', text))
-        english_words = len(re.findall(r'[a-zA-Z]+', text))
+        chinese_chars = 0
+        english_words = 0
+        for m in _TOKEN_RE.finditer(text):
+            if m.lastindex == 1:
+                chinese_chars += m.end() - m.start()
+            else:
+                english_words += 1
         return chinese_chars + int(english_words * 0.75)
     
     async def chat_stream(
@@ -1144,14 +1825,15 @@ class AsyncQwenClient:
         message_length = len(message)
         
         await self._ensure_async_primitives()
-        async with self.semaphore:
+        async with self._slot():
             for attempt in range(max_retries + 1):
                 account = None
                 start_time = time.time()
+                now_ms = int(start_time * 1000)  # 本次尝试中各载荷共用的时间戳
                 first_packet_time = None
                 generation_start_time = None
                 success = False
-                total_tokens = 0
+                chunks_out: List[str] = []
                 
                 try:
                     account = await self.account_pool.get_available_account(
@@ -1160,40 +1842,49 @@ class AsyncQwenClient:
                     if not account:
                         raise Exception("没有可用的账号")
                     
-                    files = []
-                    
-                    if file_paths:
-                        if isinstance(file_paths, str):
-                            file_paths = [file_paths]
+                    # 创建对话只依赖 token 和模型，与文件处理并发进行
+                    chat_id_task = asyncio.create_task(self._create_new_chat(account.token, model, now_ms))
+                    try:
+                        files = []
+                        
+                        if file_paths:
+                            if isinstance(file_paths, str):
+                                file_paths = [file_paths]
+                        
+                            # 所有文件并发处理（单次请求最多同时 6 个），结果保持原顺序
+                            pending_paths = [fp for fp in file_paths if fp and fp.strip()]
+                            upload_semaphore = Semaphore(6)
+                            results = await asyncio.gather(
+                                *(self._resolve_file(fp, account, upload_semaphore, now_ms) for fp in pending_paths),
+                                return_exceptions=True
+                            )
                         
-                        for file_path_or_url in file_paths:
-                            if file_path_or_url and file_path_or_url.strip():
-                                try:
-                                    if FileUtils.is_url(file_path_or_url):
-                                        file_info = await FileUtils.get_url_file_info(
-                                            self.session, file_path_or_url, account.user_id
-                                        )
-                                        file_obj = self._build_file_object(file_info)
-                                        files.append(file_obj)
-                                    else:
-                                        file_info = await self.upload_file(file_path_or_url, account)
-                                        file_obj = self._build_file_object(file_info)
-                                        files.append(file_obj)
-                                        
-                                except Exception as e:
-                                    yield f"[文件处理错误] {file_path_or_url}: {str(e)}\n"
-                                    return
+                            failed = False
+                            for file_path_or_url, result in zip(pending_paths, results):
+                                if isinstance(result, BaseException):
+                                    failed = True
+                                    yield f"[文件处理错误] {file_path_or_url}: {str(result)}\n"
+                                else:
+                                    files.append(result)
+                            if failed:
+                                return
+                        
+                        try:
+                            chat_id = await chat_id_task
+                        except Exception as e:
+                            raise Exception(f"创建对话失败: {str(e)}")
+                    finally:
+                        if not chat_id_task.done():
+                            chat_id_task.cancel()
+                        elif not chat_id_task.cancelled():
+                            chat_id_task.exception()  # 标记异常已读取，避免未处理异常告警
                     
-                    try:
-                        chat_id = await self._create_new_chat(account.token, model)
-                    except Exception as e:
-                        raise Exception(f"创建对话失败: {str(e)}")
-                    async for chunk in self._send_chat_request(account, chat_id, message, model, files):
+                    async for chunk in self._send_chat_request(account, chat_id, message, model, files, now_ms):
                         if first_packet_time is None:
                             first_packet_time = time.time()
                             generation_start_time = first_packet_time
                         
-                        total_tokens += self._estimate_tokens(chunk)
+                        chunks_out.append(chunk)
                         yield chunk
                     
                     success = True
@@ -1217,6 +1908,9 @@ class AsyncQwenClient:
                         else:
                             generation_time = 0.0
                         
+                        # token 数只用于统计，流结束后统一估算一次，不占用转发路径
+                        total_tokens = self._estimate_tokens("".join(chunks_out)) if chunks_out else 0
+                        
                         await self.account_pool.release_account(
                             account, success, message_length, 
                             first_packet_delay, total_tokens, generation_time
@@ -1228,27 +1922,31 @@ class AsyncQwenClient:
         chat_id: str, 
         message: str, 
         model: str, 
-        files: List[Dict]
+        files: List[Dict],
+        now_ms: Optional[int] = None
     ) -> AsyncGenerator[str, None]:
         """发送聊天请求"""
-        headers = {
-            "authorization": f"Bearer {account.token}",
-            "content-type": "application/json; charset=utf-8",
-            "source": "web",
-            "x-accel-buffering": "no",
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "accept": "text/event-stream",
-            "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
-            "accept-charset": "utf-8",
-            "origin": "https://chat.qwen.ai",
-            "referer": "https://chat.qwen.ai/"
-        }
+        headers = {**_COMPLETION_HEADERS, "authorization": _AUTH_FMT % account.token}
         
-        payload = self._build_payload(message, chat_id, model, files)
+        payload = self._build_payload(message, chat_id, model, files, now_ms)
         request_url = f"https://chat.qwen.ai/api/v2/chat/completions?chat_id={chat_id}"
+        
+        if self._http2_client is not None:
+            async with self._http2_client.stream(
+                "POST", request_url, content=payload, headers=headers
+            ) as response:
+                
+                if response.status_code != 200:
+                    error_text = (await response.aread()).decode('utf-8', errors='replace')
+                    raise Exception(f"HTTP {response.status_code}: {error_text}")
+                
+                async for content in self._iter_answer(response.aiter_bytes(16384)):
+                    yield content
+            return
+        
         async with self.session.post(
             request_url,
-            json=payload,
+            data=payload,
             headers=headers,
             timeout=aiohttp.ClientTimeout(total=120)
         ) as response:
@@ -1257,26 +1955,33 @@ class AsyncQwenClient:
                 error_text = await response.text()
                 raise Exception(f"HTTP {response.status}: {error_text}")
             
-            content_received = False
-            
-            async for line in response.content:
-                if not line:
-                    continue
+            async for content in self._iter_answer(response.content.iter_chunked(16384)):
+                yield content
+    
+    async def _iter_answer(self, chunks) -> AsyncGenerator[str, None]:
+        """从 SSE 字节块中解析回答内容"""
+        content_received = False
+        done = False
+        buf = bytearray()
+        
+        # 按块读取并在本地按行切分，只对 data: 负载做一次 JSON 解析（直接解析 bytes）
+        # 行在缓冲区内按下标扫描，只复制负载部分，每个块结束后统一移除已处理的数据
+        async for chunk in chunks:
+            buf += chunk
+            start = 0
+            while (nl := buf.find(b"\n", start)) != -1:
+                line_start, start = start, nl + 1
                 
-                try:
-                    line_str = line.decode('utf-8', errors='replace').strip()
-                except:
+                if not buf.startswith(b"data: ", line_start, nl):
                     continue
                 
-                if not line_str or not line_str.startswith("data: "):
-                    continue
-                
-                data_str = line_str[6:]
-                if data_str.strip() == "[DONE]":
+                payload = bytes(buf[line_start + 6:nl]).strip()
+                if payload == b"[DONE]":
+                    done = True
                     break
                 
                 try:
-                    data = json.loads(data_str)
+                    data = _loads(payload)
                     
                     if "choices" in data and data["choices"]:
                         delta = data["choices"][0].get("delta", {})
@@ -1291,8 +1996,12 @@ class AsyncQwenClient:
                 except Exception as e:
                     continue
             
-            if not content_received:
-                yield "[警告] 未收到模型回复内容\n"
+            if done:
+                break
+            del buf[:start]
+        
+        if not content_received:
+            yield "[警告] 未收到模型回复内容\n"
     
     async def chat_completion(
         self, 
@@ -1324,33 +2033,38 @@ class AsyncQwenClient:
 
 # ============= 全局客户端管理 =============
 
-_global_client = None
-_client_lock = threading.Lock()
+# aiohttp 资源与事件循环绑定，每个事件循环各持有一个客户端：id(loop) -> (loop, 客户端)
+_global_clients: Dict[int, Tuple[asyncio.AbstractEventLoop, AsyncQwenClient]] = {}
 
 async def get_client() -> AsyncQwenClient:
-    """获取全局客户端实例"""
-    global _global_client
-    
-    if _global_client is None:
-        with _client_lock:
-            if _global_client is None:
-                _global_client = AsyncQwenClient(debug=False)
-    
-    await _global_client.ensure_initialized()
-    return _global_client
+    """获取当前事件循环的全局客户端实例"""
+    loop = asyncio.get_running_loop()
+    # 未调用 cleanup_client 就结束的事件循环（如多次 asyncio.run）留下的客户端已无法使用，直接丢弃
+    for loop_id, (owner, _) in list(_global_clients.items()):
+        if owner.is_closed():
+            del _global_clients[loop_id]
+    
+    entry = _global_clients.get(id(loop))
+    if entry is None or entry[0] is not loop:
+        entry = _global_clients[id(loop)] = (loop, AsyncQwenClient(debug=False))
+    client = entry[1]
+    
+    await client.ensure_initialized()
+    return client
 
 async def cleanup_client():
-    """清理全局客户端"""
-    global _global_client
+    """清理当前事件循环的全局客户端"""
+    loop = asyncio.get_running_loop()
+    entry = _global_clients.pop(id(loop), None)
+    client = entry[1] if entry is not None and entry[0] is loop else None
     
-    if _global_client:
+    if client:
         try:
-            await _global_client.close()
+            await client.shutdown()
         except Exception as e:
             pass
-        finally:
-            with _client_lock:
-                _global_client = None
+    
+    await cleanup_shared_connector()
 
 # ============= 入口函数 =============
 
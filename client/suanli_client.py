@@ -1,12 +1,72 @@
 # 文件名：suanli_client.py
+import asyncio
+import aiohttp
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
-from typing import Optional, Dict, Any, Generator, Tuple
+from typing import Optional, Dict, Any, Generator, AsyncGenerator, Tuple
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from data.suanli_accounts import *
+
+# 优先使用 orjson 解析 JSON，未安装时回退到标准库
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    import json
+    _loads = json.loads
+    
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+# 流式输出到终端时合并写入：距上次 flush 超过该间隔（秒）或累计字符数达到阈值才真正 flush
+_STDOUT_FLUSH_INTERVAL = 0.016
+_STDOUT_FLUSH_CHARS = 64
+
+
+def _drain_sse_payloads(buf: bytearray) -> Tuple[list, bool]:
+    """从缓冲区取出所有完整行中的 data: 负载（bytes），残留的半行留在缓冲区；第二项表示是否遇到 [DONE]"""
+    payloads = []
+    start = 0
+    while (nl := buf.find(b"\n", start)) != -1:
+        line_start, start = start, nl + 1
+        if not buf.startswith(b"data:", line_start, nl):
+            continue
+        payload = bytes(buf[line_start + 5:nl]).strip()
+        if payload == b"[DONE]":
+            return payloads, True
+        payloads.append(payload)
+    del buf[:start]
+    return payloads, False
+
+
+def _iter_sse_payloads(response, chunk_size: int = 8192) -> Generator[bytes, None, None]:
+    """按块读取 SSE 响应并在本地切分行，逐个产出 data: 后的负载（bytes），遇到 [DONE] 结束"""
+    buf = bytearray()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        buf += chunk
+        payloads, done = _drain_sse_payloads(buf)
+        yield from payloads
+        if done:
+            return
+
+
+async def _aiter_sse_payloads(response: aiohttp.ClientResponse, chunk_size: int = 4096) -> AsyncGenerator[bytes, None]:
+    """_iter_sse_payloads 的 aiohttp 版本"""
+    buf = bytearray()
+    async for chunk in response.content.iter_chunked(chunk_size):
+        buf += chunk
+        payloads, done = _drain_sse_payloads(buf)
+        for payload in payloads:
+            yield payload
+        if done:
+            return
+
+
 class SuanliClient:
     """算力 API 客户端，支持流式和非流式聊天"""
     global API_KEY
@@ -33,6 +93,21 @@ class SuanliClient:
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        
+        # 复用同一个会话，保持 HTTP keep-alive，避免每次请求重新握手
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3)
+        )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+    
+    def close(self):
+        """关闭底层连接池"""
+        self._session.close()
     
     def _build_messages(self, question: str, system: Optional[str] = None) -> list:
         """构建消息列表"""
@@ -79,8 +154,8 @@ class SuanliClient:
             first_token_time = None
             answer = ""
             
-            response = requests.post(
-                url, headers=self.headers, json=data, 
+            response = self._session.post(
+                url, json=data, 
                 timeout=self.timeout, stream=True
             )
             
@@ -94,31 +169,37 @@ class SuanliClient:
                 print(f"✅ 已收到响应，状态码: {response.status_code}")
                 print("💡 模型开始生成回答：\n")
             
-            for line in response.iter_lines():
-                if line:
-                    text = line.decode('utf-8').strip()
-                    if text.startswith("data:"):
-                        data_str = text[5:].strip()
-                        if data_str == "[DONE]":
-                            break
-                        try:
-                            chunk = json.loads(data_str)
-                            content = chunk["choices"][0]["delta"].get("content", "")
-                            if content:
-                                # 记录第一个 token 的时间
-                                if first_token_time is None:
-                                    first_token_time = time.time()
-                                    ttft = first_token_time - start_time
-                                    if show_stats:
-                                        print(f"\n⏱️  首包延迟（TTFT）: {ttft:.2f} 秒\n", end="", flush=True)
-                                
-                                if show_stats:
-                                    print(content, end="", flush=True)
-                                answer += content
-                        except Exception as e:
+            out = sys.stdout
+            last_flush = time.monotonic()
+            pending_chars = 0
+            for payload in _iter_sse_payloads(response):
+                try:
+                    chunk = _loads(payload)
+                    content = chunk["choices"][0]["delta"].get("content", "")
+                    if content:
+                        # 记录第一个 token 的时间
+                        if first_token_time is None:
+                            first_token_time = time.time()
+                            ttft = first_token_time - start_time
                             if show_stats:
-                                print(f"\n⚠️  解析 chunk 失败: {e}")
-                            continue
+                                print(f"\n⏱️  首包延迟（TTFT）: {ttft:.2f} 秒\n", end="", flush=True)
+                        
+                        if show_stats:
+                            out.write(content)
+                            pending_chars += len(content)
+                            now = time.monotonic()
+                            if pending_chars >= _STDOUT_FLUSH_CHARS or now - last_flush >= _STDOUT_FLUSH_INTERVAL:
+                                out.flush()
+                                last_flush = now
+                                pending_chars = 0
+                        answer += content
+                except Exception as e:
+                    if show_stats:
+                        print(f"\n⚠️  解析 chunk 失败: {e}")
+                    continue
+            
+            if show_stats:
+                out.flush()
             
             end_time = time.time()
             total_time = end_time - start_time
@@ -189,8 +270,8 @@ class SuanliClient:
             
             start_time = time.time()
             
-            response = requests.post(
-                url, headers=self.headers, json=data, 
+            response = self._session.post(
+                url, json=data, 
                 timeout=self.timeout
             )
             
@@ -268,8 +349,8 @@ class SuanliClient:
         }
         
         try:
-            response = requests.post(
-                url, headers=self.headers, json=data, 
+            response = self._session.post(
+                url, json=data, 
                 timeout=self.timeout, stream=True
             )
             
@@ -277,25 +358,192 @@ class SuanliClient:
                 yield f"❌ 请求失败: {response.status_code}"
                 return
             
-            for line in response.iter_lines():
-                if line:
-                    text = line.decode('utf-8').strip()
-                    if text.startswith("data:"):
-                        data_str = text[5:].strip()
-                        if data_str == "[DONE]":
-                            break
-                        try:
-                            chunk = json.loads(data_str)
-                            content = chunk["choices"][0]["delta"].get("content", "")
-                            if content:
-                                yield content
-                        except Exception:
-                            continue
+            for payload in _iter_sse_payloads(response):
+                try:
+                    chunk = _loads(payload)
+                    content = chunk["choices"][0]["delta"].get("content", "")
+                    if content:
+                        yield content
+                except Exception:
+                    continue
                             
         except Exception as e:
             yield f"❌ 异常: {e}"
 
 
+class AsyncSuanliClient:
+    """算力 API 异步客户端，基于 aiohttp，所有请求共享同一个连接池，适合大量并发对话"""
+    
+    def __init__(self, 
+                 api_key: str = API_KEY,
+                 base_url: str = "https://api.suanli.cn/v1",
+                 default_model: str = "free:Qwen3-30B-A3B",
+                 timeout: int = 60):
+        """
+        初始化客户端
+        
+        Args:
+            api_key: API 密钥
+            base_url: API 基础 URL
+            default_model: 默认模型名称
+            timeout: 请求超时时间（秒）
+        """
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.default_model = default_model
+        self.timeout = timeout
+        
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        # 会话需要在事件循环内创建，首次请求时再初始化
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """获取共享会话，不存在或已关闭时重新创建"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+    
+    async def close(self):
+        """关闭底层会话和连接池"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+    
+    def _build_messages(self, question: str, system: Optional[str] = None) -> list:
+        """构建消息列表"""
+        messages = []
+        if system:
+            messages.append({"role": "system", "content": system})
+        messages.append({"role": "user", "content": question})
+        return messages
+    
+    async def chat_stream_generator(self, 
+                                    question: str, 
+                                    model: Optional[str] = None,
+                                    system: Optional[str] = None,
+                                    **kwargs) -> AsyncGenerator[str, None]:
+        """
+        异步流式聊天生成器，逐个yield内容块
+        
+        Args:
+            question: 用户问题
+            model: 模型名称
+            system: 系统提示词
+            **kwargs: 其他参数
+            
+        Yields:
+            每个内容块的文本
+        """
+        url = f"{self.base_url}/chat/completions"
+        data = {
+            "model": model or self.default_model,
+            "messages": self._build_messages(question, system),
+            "stream": True,
+            **kwargs
+        }
+        
+        try:
+            async with self._get_session().post(url, data=_dumps(data)) as response:
+                if response.status != 200:
+                    yield f"❌ 请求失败: {response.status}"
+                    return
+                
+                async for payload in _aiter_sse_payloads(response):
+                    try:
+                        chunk = _loads(payload)
+                        content = chunk["choices"][0]["delta"].get("content", "")
+                        if content:
+                            yield content
+                    except Exception:
+                        continue
+                        
+        except asyncio.TimeoutError:
+            yield f"❌ 读取超时：服务器在 {self.timeout} 秒内未完成响应"
+        except Exception as e:
+            yield f"❌ 异常: {e}"
+    
+    async def chat_stream(self, 
+                          question: str, 
+                          model: Optional[str] = None,
+                          system: Optional[str] = None,
+                          **kwargs) -> Optional[str]:
+        """
+        异步流式聊天，返回拼接后的完整回答
+        
+        Returns:
+            完整的回答文本，如果失败返回 None
+        """
+        parts = []
+        async for content in self.chat_stream_generator(question, model, system, **kwargs):
+            if content.startswith("❌"):
+                return None
+            parts.append(content)
+        return "".join(parts)
+    
+    async def chat(self, 
+                   question: str, 
+                   model: Optional[str] = None,
+                   system: Optional[str] = None,
+                   **kwargs) -> Tuple[Optional[str], Dict[str, Any]]:
+        """
+        异步非流式聊天，一次性返回完整结果
+        
+        Returns:
+            (回答文本, 统计信息字典)，如果失败回答文本为 None
+        """
+        url = f"{self.base_url}/chat/completions"
+        data = {
+            "model": model or self.default_model,
+            "messages": self._build_messages(question, system),
+            "stream": False,
+            **kwargs
+        }
+        
+        stats = {
+            "success": False,
+            "total_time": 0,
+            "status_code": None,
+            "token_count": 0,
+            "answer_length": 0
+        }
+        
+        start_time = time.time()
+        try:
+            async with self._get_session().post(url, data=_dumps(data)) as response:
+                stats["status_code"] = response.status
+                if response.status != 200:
+                    return None, stats
+                result = await response.json(loads=_loads)
+            
+            answer = result["choices"][0]["message"]["content"]
+            stats["success"] = True
+            stats["answer_length"] = len(answer)
+            if "usage" in result:
+                stats["token_count"] = result["usage"].get("total_tokens", 0)
+            return answer, stats
+            
+        except asyncio.TimeoutError:
+            return None, stats
+        except Exception:
+            return None, stats
+        finally:
+            stats["total_time"] = time.time() - start_time
+
+
 # === 使用示例 ===
 if __name__ == "__main__":
     # 初始化客户端
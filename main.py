@@ -3,7 +3,7 @@ import threading
 import asyncio
 import os
 from printstream import *
-from model_utils import chat_stream
+from model_utils import chat_stream, close_session
 
 # 启动服务器
 def run_server():
@@ -45,8 +45,18 @@ async def main():
     # 调用模型一次
     await call_model_once()
 
+    # 关闭共享的 HTTP 会话
+    await close_session()
+
     # 程序结束
     print("[INFO] 任务完成，程序退出")
 
 if __name__ == "__main__":
+    # 安装了 uvloop 时使用其事件循环策略；设置环境变量 DISABLE_UVLOOP=1 可关闭
+    if os.environ.get("DISABLE_UVLOOP", "") not in ("1", "true", "True"):
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
     asyncio.run(main())
@@ -7,6 +7,17 @@ import sys
 import os
 from typing import Optional, List, Dict, Any, AsyncGenerator
 from dotenv import load_dotenv
+
+# 优先使用 orjson 编解码 JSON，未安装时回退到标准库
+try:
+    import orjson
+    _loads = orjson.loads
+    
+    def _json_serialize(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    _loads = json.loads
+    _json_serialize = json.dumps
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 if __name__ != "__main__":
     from __main__ import *
@@ -15,6 +26,42 @@ else:
 
 BASE_URL = "http://localhost:8000"
 
+# 接口地址在导入时拼好，避免每次调用重新格式化
+_CHAT_URL = f"{BASE_URL}/v1/chat/completions"
+_HEALTH_URL = f"{BASE_URL}/v1/health"
+_MODELS_URL = f"{BASE_URL}/v1/models"
+
+# 模型列表很少变化，成功结果缓存一段时间（秒）
+_MODELS_CACHE_TTL = 60.0
+_models_cache: Optional[tuple] = None  # (过期时间, 模型列表)
+
+# 共享会话与事件循环绑定，每个事件循环各持有一个，循环内所有请求复用同一个连接池
+_sessions: Dict[int, aiohttp.ClientSession] = {}
+
+def _get_session() -> aiohttp.ClientSession:
+    """返回当前事件循环上的共享会话
+    
+    检查与创建之间没有 await，单个事件循环内无需加锁。
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(id(loop))
+    # 循环关闭后 id 可能被新循环复用，旧会话已无法在原循环上关闭，直接替换
+    if session is None or session.closed or getattr(session, '_loop', loop) is not loop:
+        session = _sessions[id(loop)] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75),
+            json_serialize=_json_serialize
+        )
+    return session
+
+async def close_session():
+    """关闭当前事件循环的共享会话（进程退出时调用）"""
+    session = _sessions.pop(id(asyncio.get_running_loop()), None)
+    if session and not session.closed:
+        try:
+            await session.close()
+        except Exception:
+            pass
+
 async def chat(message: str, files: Optional[List[str]] = None, model: str = "auto_chat", temperature: float = 0.7) -> str:
     """非流式聊天"""
     try:
@@ -33,13 +80,13 @@ async def chat(message: str, files: Optional[List[str]] = None, model: str = "au
             "temperature": temperature
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{BASE_URL}/v1/chat/completions", json=payload) as response:
-                result = await response.json()
-                if response.status == 200:
-                    return result['choices'][0]['message']['content']
-                else:
-                    return f"请求失败: {response.status}"
+        session = _get_session()
+        async with session.post(_CHAT_URL, json=payload) as response:
+            result = await response.json(loads=_loads)
+            if response.status == 200:
+                return result['choices'][0]['message']['content']
+            else:
+                return f"请求失败: {response.status}"
     except Exception as e:
         return f"聊天请求失败: {e}"
 
@@ -61,30 +108,30 @@ async def chat_stream_func(message: str, files: Optional[List[str]] = None, mode
             "temperature": temperature
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{BASE_URL}/v1/chat/completions", json=payload) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    yield f"请求失败: {response.status} - {error_text}"
-                    return
+        session = _get_session()
+        async with session.post(_CHAT_URL, json=payload) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                yield f"请求失败: {response.status} - {error_text}"
+                return
+            
+            async for line in response.content:
+                line_text = line.decode('utf-8').strip()
+                if not line_text or not line_text.startswith('data: '):
+                    continue
                 
-                async for line in response.content:
-                    line_text = line.decode('utf-8').strip()
-                    if not line_text or not line_text.startswith('data: '):
-                        continue
-                    
-                    data = line_text[6:]
-                    if data == '[DONE]':
-                        break
-                    
-                    try:
-                        chunk = json.loads(data)
-                        if 'choices' in chunk and chunk['choices']:
-                            delta = chunk['choices'][0].get('delta', {})
-                            if 'content' in delta:
-                                yield delta['content']
-                    except json.JSONDecodeError:
-                        continue
+                data = line_text[6:]
+                if data == '[DONE]':
+                    break
+                
+                try:
+                    chunk = _loads(data)
+                    if 'choices' in chunk and chunk['choices']:
+                        delta = chunk['choices'][0].get('delta', {})
+                        if 'content' in delta:
+                            yield delta['content']
+                except ValueError:
+                    continue
     except Exception as e:
         yield f"流式聊天失败: {e}"
 
@@ -170,13 +217,13 @@ async def text_to_speech(text: str, voice: str = "派蒙") -> str:
             "voice": voice
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{BASE_URL}/v1/chat/completions", json=payload) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result.get('file_path', '音频路径未找到')
-                else:
-                    return f"TTS请求失败: {response.status}"
+        session = _get_session()
+        async with session.post(_CHAT_URL, json=payload) as response:
+            if response.status == 200:
+                result = await response.json(loads=_loads)
+                return result.get('file_path', '音频路径未找到')
+            else:
+                return f"TTS请求失败: {response.status}"
     except Exception as e:
         return f"TTS请求异常: {e}"
 
@@ -188,37 +235,44 @@ async def get_embedding(text: str) -> List[float]:
             "messages": [{"role": "user", "content": text}]
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{BASE_URL}/v1/chat/completions", json=payload) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result['data'][0]['embedding']
-                else:
-                    return []
+        session = _get_session()
+        async with session.post(_CHAT_URL, json=payload) as response:
+            if response.status == 200:
+                result = await response.json(loads=_loads)
+                return result['data'][0]['embedding']
+            else:
+                return []
     except Exception as e:
         return []
 
 async def get_health() -> Dict[str, Any]:
     """获取健康状态"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{BASE_URL}/v1/health") as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    return {"error": f"健康检查失败: {response.status}"}
+        session = _get_session()
+        async with session.get(_HEALTH_URL) as response:
+            if response.status == 200:
+                return await response.json(loads=_loads)
+            else:
+                return {"error": f"健康检查失败: {response.status}"}
     except Exception as e:
         return {"error": f"健康检查异常: {e}"}
 
 async def get_models() -> List[str]:
     """获取可用模型列表"""
+    global _models_cache
+    
+    if _models_cache is not None and time.monotonic() < _models_cache[0]:
+        return list(_models_cache[1])
+    
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{BASE_URL}/v1/models") as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return [model['id'] for model in result.get('data', [])]
-                else:
-                    return [f"获取模型列表失败: {response.status}"]
+        session = _get_session()
+        async with session.get(_MODELS_URL) as response:
+            if response.status == 200:
+                result = await response.json(loads=_loads)
+                models = [model['id'] for model in result.get('data', [])]
+                _models_cache = (time.monotonic() + _MODELS_CACHE_TTL, tuple(models))
+                return models
+            else:
+                return [f"获取模型列表失败: {response.status}"]
     except Exception as e:
         return [f"获取模型列表异常: {e}"]